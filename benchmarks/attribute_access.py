@@ -0,0 +1,59 @@
+"""Measures the time of a token transfer and the memory allocated by reading a variable of the token.
+
+Run it from the folder containing dvm: python -m dvm.benchmarks.attribute_access
+"""
+import timeit
+import tracemalloc
+
+from dvm.contract import Contract, ExecutionContext
+from dvm.state import Journal
+from dvm.vm import compile_contract, contract_globals
+
+SOURCE_CODE = '''
+@Contract.deploy
+class Token(Contract):
+    def transfer(self, source: str, to: str, amount: int):
+        assert self.balances[source] >= amount, 'not enough balance'
+        self.balances[source] = self.balances[source] - amount
+        self.balances[to] = self.balances.get(to, 0) + amount
+        self.transfers = self.transfers + 1
+        return self.address
+'''
+
+NUMBER = 10000
+
+
+def instantiate() -> Contract:
+    context = ExecutionContext.current()
+    exec(compile_contract(SOURCE_CODE), contract_globals, {})
+    contract_class, context.deployed = context.deployed, None
+    return contract_class('0' * 64, {'balances': {'a': NUMBER * 10, 'b': 0}, 'transfers': 0})
+
+
+def main():
+    token = instantiate()
+    context = ExecutionContext.current()
+    transfer = token._methods['transfer']
+
+    def call():
+        # every call gets its own journal, as in the daemon
+        context.journal = Journal()
+        transfer('a', 'b', 1)
+
+    call_time = min(timeit.repeat(call, number=NUMBER, repeat=5)) / NUMBER
+    read_time = min(timeit.repeat(lambda: token.transfers, number=NUMBER * 10, repeat=5)) / (NUMBER * 10)
+
+    # the temporary objects built while resolving the attribute show up in the peak of the memory allocated
+    tracemalloc.start()
+    getattr(token, 'transfers')
+    tracemalloc.reset_peak()
+    current = tracemalloc.get_traced_memory()[0]
+    getattr(token, 'transfers')
+    peak = tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+
+    print(f'transfer: {call_time * 1e6:.2f} us, variable read: {read_time * 1e9:.0f} ns, {peak} bytes allocated at peak')
+
+
+if __name__ == '__main__':
+    main()
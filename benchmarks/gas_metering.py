@@ -0,0 +1,62 @@
+"""Compares contract execution with and without gas metering.
+
+Run it from the folder containing dvm: python -m dvm.benchmarks.gas_metering
+"""
+import timeit
+
+from dvm.contract import Contract, ExecutionContext
+from dvm.vm import compile_contract, contract_globals
+
+SOURCE_CODE = '''
+@Contract.deploy
+class Benchmark(Contract):
+    def loop(self, n: int):
+        total = 0
+        i = 0
+        while i < n:
+            total += i
+            i += 1
+        return total
+
+    def iterate(self, n: int):
+        total = 0
+        for i in range(n):
+            total += i
+        return total
+
+    def comprehension(self, n: int):
+        return sum([i * i for i in range(n)])
+
+    def calls(self, n: int):
+        return sum([self.square(i) for i in range(n)])
+
+    def square(self, i: int):
+        return i * i
+'''
+
+N = 10000
+NUMBER = 20
+
+
+def instantiate(metering: bool) -> Contract:
+    context = ExecutionContext.current()
+    exec(compile_contract(SOURCE_CODE, metering), contract_globals, {})
+    contract_class, context.deployed = context.deployed, None
+    return contract_class('0' * 64, {})
+
+
+def main():
+    plain, metered = instantiate(False), instantiate(True)
+    for method in ('loop', 'iterate', 'comprehension', 'calls'):
+        plain_time = min(timeit.repeat(lambda: plain._methods[method](N), number=NUMBER, repeat=5)) / NUMBER
+        context = ExecutionContext.current()
+        context.additional_gas, context.metered = 0, True
+        metered_time = min(timeit.repeat(lambda: metered._methods[method](N), number=NUMBER, repeat=5)) / NUMBER
+        gas = context.additional_gas // (NUMBER * 5)
+        context.metered = False
+        print(f'{method:>14}: {plain_time * 1e3:8.3f} ms plain, {metered_time * 1e3:8.3f} ms metered '
+              f'({metered_time / plain_time:.2f}x), {gas} gas')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+"""Measures the cost of journaling the first write to a variable, for variables of growing size.
+
+Run it from the folder containing dvm: python -m dvm.benchmarks.journal
+"""
+import timeit
+from copy import deepcopy
+
+from dvm.state import Journal
+
+SIZES = (10, 1000, 100000)
+NUMBER = 20
+
+
+def measure(variables: dict) -> float:
+    def record():
+        Journal().record(variables, 'value')
+
+    return min(timeit.repeat(record, number=NUMBER, repeat=5)) / NUMBER
+
+
+def main():
+    for size in SIZES:
+        flat = {'value': {str(i): i for i in range(size)}}
+        nested = {'value': {str(i): [i] for i in range(size)}}
+        deep_time = min(timeit.repeat(lambda: deepcopy(flat['value']), number=NUMBER, repeat=5)) / NUMBER
+        print(f'{size} entries: flat dict {measure(flat) * 1e6:.1f} us (deepcopy {deep_time * 1e6:.1f} us), '
+              f'dict of lists {measure(nested) * 1e6:.1f} us')
+
+
+if __name__ == '__main__':
+    main()
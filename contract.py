@@ -1,15 +1,25 @@
 import inspect
 import json
 import zlib
-from io import BytesIO
+from collections.abc import MutableMapping
+from contextvars import ContextVar
+from decimal import Decimal
 from typing import Dict, List, Tuple
 
 from denaro.constants import ENDIAN
 from denaro.transactions import TransactionOutput
-from dvm.serializer import serialize, deserialize
+from dvm.serializer import Type, deserialize, deserialize_at, read_bytes_at, serialize, serialized_size
+from dvm.state import IMMUTABLE_TYPES, Journal, unshared
 
 CURRENT_VERSION = b"dvm0\0"
 CONTRACT_METHOD_TIMEOUT = 0.01
+# attributes of contracts that cannot be used as variables
+RESERVED_NAMES = frozenset(('reserved', 'create', 'emit', 'deploy', 'wrap', 'address', 'transaction', 'block'))
+# larger decompressed payloads are rejected, since messages of transactions could be zip bombs
+MAX_PAYLOAD_SIZE = 2 ** 20
+# block from which payloads are parsed with the strict rules only, it changes which transactions are valid,
+# so every node has to use the same one, unset until it is scheduled
+STRICT_PAYLOAD_BLOCK: int | None = None
 
 
 class Address:
@@ -48,52 +58,127 @@ class Block(dict):
     ...
 
 
-class ContractsCache:
-    # fixme
-    contracts: Dict[str, "Contract"] = {}
-    contracts_backup: Dict[str, "Contract"] = {}
-    contract_instances: list = []
-    current_contract_hash: str = None
+class ExecutionContext:
+    """State of the contract calls being executed, the daemon uses one for each block and the server one for each request.
 
-    current_transaction: DVMTransaction = None
-    current_block: "Block" = None
-    additional_gas: int = 0
+    It is carried by a context variable, so that executions running in different tasks do not share it.
+    """
 
-    emitted_events: List[Tuple[str, Event]] = []
-    created_contracts: List[tuple] = []
+    def __init__(self, contracts: Dict[str, "Contract"] = None, block: Block = None):
+        self.contracts: Dict[str, Contract] = {} if contracts is None else contracts
+        self.journal: Journal | None = None
+        self.contract_instances: list = []
+        self.current_contract_hash: str | None = None
+
+        self.current_transaction: DVMTransaction | None = None
+        self.current_block: Block | None = block
+        # block of the persisted states that contracts loaded during the execution are read at, None for the latest
+        self.block_no: int | None = None
+        self.additional_gas: int = 0
+        # statements run by contracts are charged gas, only for the calls of blocks from GAS_METERING_BLOCK
+        self.metered: bool = False
+        # gas the current call can pay for, metered contract code stops once additional_gas exceeds it
+        self.gas_limit: Decimal | float = float('inf')
+
+        self.emitted_events: List[Tuple[str, Event]] = []
+        self.created_contracts: List[tuple] = []
+        # (storage map, key) of storage entries that were needed but not loaded, key is None for the whole map
+        self.storage_misses: List[tuple] = []
+        # contract class deployed by the source code being executed
+        self.deployed: type | None = None
 
     @staticmethod
-    async def get(contract_hash):
-        if contract_hash not in ContractsCache.contracts:
-            raise NotImplementedError()
-        return ContractsCache.contracts[contract_hash]
+    def current() -> "ExecutionContext":
+        context = _execution_context.get(None)
+        if context is None:
+            context = ExecutionContext()
+            _execution_context.set(context)
+        return context
+
+    def activate(self) -> "ExecutionContext":
+        _execution_context.set(self)
+        return self
+
+
+_execution_context: ContextVar[ExecutionContext] = ContextVar('execution_context')
+
+
+class MethodSignature:
+    """What the wrapper of a contract method checks on each call, computed once per contract class."""
+
+    def __init__(self, func):
+        if func.__code__.co_argcount - 1 > len(func.__annotations__):
+            raise TypeError(f'Method {func.__name__} types must be specified')
+        self.func = func
+        self.name: str = func.__name__
+        self.args: Tuple[str, ...] = func.__code__.co_varnames[1:func.__code__.co_argcount]
+        # expected types of the positional arguments, in the order of the annotations
+        self.types: Tuple[type, ...] = tuple(func.__annotations__.values())
+        self.annotations: dict = func.__annotations__
+        self.sender: bool = bool(self.args) and self.args[0] == 'sender'
+        self.is_coroutine: bool = inspect.iscoroutinefunction(func)
 
 
 class Contract:
-    deployed: "Contract" = None
+    # classes of contracts are not slotted, their instances keep the wrappers of the methods in their __dict__
+    __slots__ = (
+        '_contract_hash', '_variables', '_methods', '_caller_contract', '_encoded_state', '_state_diffs', '_state_block',
+        '_dirty', '_source_code', '_creation'
+    )
 
     # todo rename sender?
     def __init__(self, contract_hash: str, variables: dict, methods: dict = None):
         self._contract_hash = contract_hash
         self._variables = variables
         self._methods = methods or {}
-        self._caller_contract: Address
+        self._caller_contract: Address | None = None
+        # last persisted encoded state and number of diffs written since the last checkpoint
+        self._encoded_state: Dict[str, str] | None = None
+        self._state_diffs: int = 0
+        # block of the last persisted state, with the contract hash it identifies the encoded state
+        self._state_block: int | None = None
+        # variables that may have changed since the last persisted state: assigned ones, and mutable ones that have been
+        # read, since their nested values can be changed in place without going through the contract
+        self._dirty: set = set()
+        # source code of contracts loaded from the database, to run them elsewhere
+        self._source_code: str | None = None
+        # creation transaction and compressed source code while the contract has not been written yet
+        self._creation: tuple | None = None
 
         if not methods:
-            for name, func in inspect.getmembers(self, predicate=inspect.ismethod):
-                if not func.__qualname__.startswith(self.__class__.__name__):
-                    continue
-                if getattr(self.__class__, name):  # the check fails for inherited classes
-                    delattr(self.__class__, name)
-                self.wrap(func)
+            for signature in self.__class__._method_signatures().values():
+                self.wrap(signature)
+        # methods are found without going through __getattr__, attributes of the class still take precedence
+        for name, wrapper in self._methods.items():
+            if not hasattr(self.__class__, name):
+                self.__dict__[name] = wrapper
 
     @staticmethod
     def deploy(obj):
-        assert Contract.deployed is None, 'cannot deploy: already deployed'
+        context = ExecutionContext.current()
+        assert context.deployed is None, 'cannot deploy: already deployed'
         assert issubclass(obj, Contract), 'cannot deploy: contract does not inherit from main class'
-        Contract.deployed = obj
+        obj._method_signatures()
+        context.deployed = obj
         return obj
 
+    @classmethod
+    def _method_signatures(cls) -> Dict[str, "MethodSignature"]:
+        """Returns the signatures of the methods defined by the class, computed the first time and shared by its instances.
+
+        The methods are removed from the class, so that accessing them on an instance goes through the wrappers.
+        """
+        signatures = vars(cls).get('_signatures')
+        if signatures is None:
+            signatures = {
+                name: MethodSignature(func) for name, func in list(vars(cls).items())
+                if inspect.isfunction(func) and func.__qualname__.startswith(cls.__name__)
+            }
+            for name in signatures:
+                delattr(cls, name)
+            cls._signatures = signatures
+        return signatures
+
     def reserved(self):
         return {
             'reserved': None,
@@ -103,27 +188,27 @@ class Contract:
             'wrap': None,
 
             'address': self._contract_hash,
-            'transaction': ContractsCache.current_transaction,
-            'block': ContractsCache.current_block
+            'transaction': ExecutionContext.current().current_transaction,
+            'block': ExecutionContext.current().current_block
         }
 
     # todo
     @classmethod
     def create(cls, *args, **kwargs):
-        ContractsCache.created_contracts.append((ContractsCache.current_contract_hash, cls.__name__, CURRENT_VERSION, args, kwargs))
+        context = ExecutionContext.current()
+        context.created_contracts.append((context.current_contract_hash, cls.__name__, CURRENT_VERSION, args, kwargs))
 
     def emit(self, event: Event):
         assert isinstance(event, Event), 'you can only emit instances of Event'
-        ContractsCache.emitted_events.append((self._contract_hash, event))
+        ExecutionContext.current().emitted_events.append((self._contract_hash, event))
 
-    def wrap(self, func):
-        assert (func.__name__ not in self._methods)
-        if func.__code__.co_argcount - 1 > len(func.__annotations__):
-            raise TypeError(f'Method {func.__name__} types must be specified')
+    def wrap(self, signature: "MethodSignature"):
+        assert (signature.name not in self._methods)
+        func = signature.func.__get__(self)
+        name, types, annotations, sender = signature.name, signature.types, signature.annotations, signature.sender
 
         def do_checks(args, kwargs):
-            func_args = inspect.getfullargspec(func).args[1:]
-            if func_args and func_args[0] == 'sender':
+            if sender:
                 if args[0].__class__ != Address:
                     if self._caller_contract is not None:
                         args = (self._caller_contract, *args)
@@ -133,29 +218,28 @@ class Contract:
 
                 print(f"calling {self._contract_hash} from {args[0]}")
             for i, arg in enumerate(args):
-                should_be = list(func.__annotations__.values())[i]
+                should_be = types[i]
                 if type(arg) != should_be:
-                    raise TypeError(f'Parameter {i + 1} of {func.__name__} method must be {should_be.__name__}, not {type(arg).__name__}')
+                    raise TypeError(f'Parameter {i + 1} of {name} method must be {should_be.__name__}, not {type(arg).__name__}')
             for i, (key, arg) in enumerate(kwargs.items()):
-                should_be = func.__annotations__[key]
-                # fixme
-                from decimal import Decimal
+                should_be = annotations[key]
                 if type(arg) is str and should_be is Decimal:
                     kwargs[key] = Decimal(arg)
                 elif type(arg) is str and should_be is int:
                     kwargs[key] = int(arg)
                 elif type(arg) != should_be:
-                    raise TypeError(f'Parameter {i + 1} of {func.__name__} method must be {should_be.__name__}, not {type(arg).__name__}')
+                    raise TypeError(f'Parameter {i + 1} of {name} method must be {should_be.__name__}, not {type(arg).__name__}')
             return args, kwargs
 
-        if inspect.iscoroutinefunction(func):
+        if signature.is_coroutine:
             async def wrapper(*args, **kwargs):
                 args, kwargs = do_checks(args, kwargs)
                 try:
-                    previous_contract = ContractsCache.current_contract_hash
-                    ContractsCache.current_contract_hash = self._contract_hash
+                    context = ExecutionContext.current()
+                    previous_contract = context.current_contract_hash
+                    context.current_contract_hash = self._contract_hash
                     res = await func(*args, **kwargs)
-                    ContractsCache.current_contract_hash = previous_contract
+                    context.current_contract_hash = previous_contract
                     return res
                 except Exception:
                     print('caught in ', self._contract_hash, args)
@@ -164,44 +248,286 @@ class Contract:
             def wrapper(*args, **kwargs):
                 args, kwargs = do_checks(args, kwargs)
                 try:
-                    previous_contract = ContractsCache.current_contract_hash
-                    ContractsCache.current_contract_hash = self._contract_hash
+                    context = ExecutionContext.current()
+                    previous_contract = context.current_contract_hash
+                    context.current_contract_hash = self._contract_hash
                     res = func(*args, **kwargs)
-                    ContractsCache.current_contract_hash = previous_contract
+                    context.current_contract_hash = previous_contract
                     return res
                 except Exception:
                     print('caught in ', self._contract_hash, args)
                     raise
-        self._methods[func.__name__] = wrapper
+        self._methods[name] = wrapper
 
     def __getattr__(self, key: str):
+        # only reached for reserved names and variables, methods are in the __dict__ of the instance
         if key[0] == '_':
             return super(Contract, self).__getattribute__(key)
-        if key in self.reserved():
-            return self.reserved()[key]
-        if key in self._variables:
-            return self._variables[key]
-        elif key in self._methods:
-            return self._methods[key]
-        else:
-            return super(Contract, self).__getattribute__(key)
+        if key in RESERVED_NAMES:
+            if key == 'address':
+                return self._contract_hash
+            if key == 'transaction':
+                return ExecutionContext.current().current_transaction
+            if key == 'block':
+                return ExecutionContext.current().current_block
+            return None
+        variables = self._variables
+        if key in variables:
+            value = variables[key]
+            if type(value) is StorageMap:
+                # storage maps journal their own entries
+                self._dirty.add(key)
+            elif type(value) not in IMMUTABLE_TYPES:
+                # writes to a dict or list are not tracked, calling its methods does not go through _write_, so it
+                # is journaled and encoded again when persisting, which only writes it if its encoding changed
+                self._touch(key)
+            return value
+        return super(Contract, self).__getattribute__(key)
 
     def __setattr__(self, key: str, value):
         if key[0] == '_':
             super(Contract, self).__setattr__(key, value)
         else:
             assert key not in self._methods, f'overwriting {key} method'
-            assert key not in self.reserved(), 'overwriting reserved property'
-            self._variables[key] = value
+            assert key not in RESERVED_NAMES, 'overwriting reserved property'
+            self._touch(key)
+            self._variables[key] = unshared(value)
+
+    def _touch(self, key: str):
+        journal = ExecutionContext.current().journal
+        if journal is not None:
+            # a variable that is not dirty still has the value of the persisted state, so its size is already known
+            size = None
+            if key not in self._dirty and self._encoded_state is not None and type(self._encoded_state.get(key)) is str:
+                size = len(self._encoded_state[key]) // 2
+            journal.record(self._variables, key, size)
+        self._dirty.add(key)
 
     def get_payload(self, method: str, args: tuple, specifier: bytes = CURRENT_VERSION):
         return ContractCall(specifier, str(self._contract_hash), method, args).get_payload()
 
+    def get_encoded_state(self):
+        if self._encoded_state is None:
+            return {k: serialize(v).hex() for k, v in self._variables.items()}
+        return self._encoded_state | {k: serialize(self._variables[k]).hex() for k in self._dirty}
+
     def get_json_state(self):
-        return json.dumps({k: serialize(v).hex() for k, v in self._variables.items()})
+        return json.dumps(self.get_encoded_state())
+
+
+class OutOfGas(Exception):
+    def __init__(self, limit):
+        super().__init__(f'Gas limit of {limit} exceeded')
+
+
+class StorageMiss(Exception):
+    def __init__(self, contract_hash: str, var: str, key=None):
+        super().__init__(f'Storage entry {key!r} of {var} in contract <{contract_hash}> is not loaded')
+
+
+class StorageMap(MutableMapping):
+    """Top-level dict variable stored per key in dvm_storage, its entries are loaded on demand.
+
+    Accessing an entry that has not been loaded raises StorageMiss and records it in the storage_misses of the ExecutionContext,
+    the call is then reverted and executed again once the entry has been fetched.
+    Entries are looked up by their encoded key, as in dvm_storage, so keys that are equal but encoded differently
+    (1 and True) are distinct, while keys encoded the same (Decimal('1.0') and Decimal('1')) are the same entry.
+    """
+
+    def __init__(self, contract_hash: str, var: str, meta: dict, until: int = None):
+        self._contract_hash = contract_hash
+        self._var = var
+        # block up to which entries are read, None for the latest
+        self._until = until
+        self._since = meta['since']
+        self._length = meta['length']
+        self._size = meta['size']
+        self._next = meta['next']
+        # encoded key -> (position, value) of the loaded entries
+        self._entries: Dict[bytes, tuple] = {}
+        # encoded key -> encoded size of the key and its persisted value, 0 if the key is not persisted
+        self._sizes: Dict[bytes, int] = {}
+        # encoded keys of the entries changed since the last persist
+        self._touched: set = set()
+        self._complete = self._length == 0
+
+    @staticmethod
+    def encode_key(key) -> bytes:
+        # unhashable keys are rejected like by a dict, even if they could be encoded
+        hash(key)
+        return serialize(key)
+
+    def _miss(self, key=None):
+        ExecutionContext.current().storage_misses.append((self, key))
+        raise StorageMiss(self._contract_hash, self._var, key)
+
+    def _check(self, key) -> bytes:
+        encoded_key = self.encode_key(key)
+        if encoded_key not in self._sizes and not self._complete:
+            self._miss(key)
+        return encoded_key
+
+    def _touch(self, encoded_key: bytes):
+        journal = ExecutionContext.current().journal
+        if journal is not None:
+            size = None
+            if encoded_key not in self._touched and self._sizes.get(encoded_key):
+                size = self._sizes[encoded_key] - len(encoded_key)
+            journal.record_entry(self, encoded_key, size)
+        self._touched.add(encoded_key)
+
+    def __getitem__(self, key):
+        encoded_key = self._check(key)
+        entry = self._entries.get(encoded_key)
+        if entry is None:
+            raise KeyError(key)
+        if type(entry[1]) not in IMMUTABLE_TYPES:
+            self._touch(encoded_key)
+        return entry[1]
+
+    def __contains__(self, key):
+        return self._check(key) in self._entries
+
+    def __setitem__(self, key, value):
+        encoded_key = self._check(key)
+        self._touch(encoded_key)
+        entry = self._entries.get(encoded_key)
+        if entry is None:
+            entry = (self._next, None)
+            self._next += 1
+        self._entries[encoded_key] = (entry[0], unshared(value))
+
+    def __delitem__(self, key):
+        encoded_key = self._check(key)
+        if encoded_key not in self._entries:
+            raise KeyError(key)
+        self._touch(encoded_key)
+        del self._entries[encoded_key]
+
+    def __iter__(self):
+        if not self._complete:
+            self._miss()
+        entries = self._entries
+        return (deserialize(encoded_key) for encoded_key in sorted(entries, key=lambda encoded_key: entries[encoded_key][0]))
+
+    def __len__(self):
+        return self._length + sum((key in self._entries) - (self._sizes.get(key, 0) > 0) for key in self._touched)
+
+    def __repr__(self):
+        return f'StorageMap <{self._contract_hash}.{self._var}> ({len(self)} entries)'
+
+    def copy(self):
+        return dict(self.items())
+
+    def __deepcopy__(self, memo):
+        # entries are journaled one by one, so a replaced map is journaled by reference
+        return self
+
+    def encoded_size(self):
+        size = self._size
+        for key in self._touched:
+            if key in self._entries:
+                size += len(key) + serialized_size(self._entries[key][1])
+            size -= self._sizes.get(key, 0)
+        return 1 + serialized_size(len(self)) + size
+
+    def load(self, rows: list, keys: list = None):
+        """Adds the persisted (key, position, value) rows, encoded keys that have been requested but have no row are missing."""
+        for key_hex, position, value_hex in rows:
+            key = bytes.fromhex(key_hex)
+            if key in self._sizes:
+                continue
+            if value_hex is None:
+                self._sizes[key] = 0
+                continue
+            self._sizes[key] = (len(key_hex) + len(value_hex)) // 2
+            self._entries[key] = (position, deserialize(bytes.fromhex(value_hex)))
+        if keys is None:
+            self._complete = True
+        else:
+            for key in keys:
+                self._sizes.setdefault(key, 0)
+
+    def persist(self, block_no: int, rows: list) -> dict:
+        """Appends the rows of the entries touched since the last persist and returns the new meta of the map."""
+        length = len(self)
+        size = self.encoded_size() - 1 - serialized_size(length)
+        for key in self._touched:
+            key_hex = key.hex()
+            if key in self._entries:
+                position, value = self._entries[key]
+                value_hex = serialize(value).hex()
+                rows.append((self._contract_hash, self._var, key_hex, block_no, position, value_hex))
+                self._sizes[key] = (len(key_hex) + len(value_hex)) // 2
+            else:
+                rows.append((self._contract_hash, self._var, key_hex, block_no, None, None))
+                self._sizes[key] = 0
+        self._length, self._size = length, size
+        self._touched.clear()
+        return self.meta()
+
+    def meta(self) -> dict:
+        return {'since': self._since, 'length': self._length, 'size': self._size, 'next': self._next}
+
+    @staticmethod
+    def convert(contract_hash: str, var: str, value: dict, block_no: int, rows: list) -> dict:
+        """Appends the rows of all the entries of a plain dict and returns the meta of the map replacing it."""
+        size = 0
+        for position, (key, item) in enumerate(value.items()):
+            key_hex, value_hex = serialize(key).hex(), serialize(item).hex()
+            rows.append((contract_hash, var, key_hex, block_no, position, value_hex))
+            size += (len(key_hex) + len(value_hex)) // 2
+        return {'since': block_no, 'length': len(value), 'size': size, 'next': len(value)}
+
+
+def _decompress(payload: memoryview, limit: int | None = MAX_PAYLOAD_SIZE) -> Tuple[memoryview, int]:
+    """Returns the decompressed payload and its size if it is a zlib stream, the payload itself and 0 otherwise.
+
+    The size is not limited if limit is None.
+    """
+    # a zlib stream starts with a deflate CMF byte and a FLG byte making the header a multiple of 31
+    if len(payload) < 2 or payload[0] & 0x0F != 8 or (payload[0] << 8 | payload[1]) % 31:
+        return payload, 0
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(payload, 0 if limit is None else limit + 1)
+    except zlib.error:
+        return payload, 0
+    if limit is not None and len(data) > limit:
+        raise ValueError(f'Payload is larger than {MAX_PAYLOAD_SIZE} bytes once decompressed')
+    if not decompressor.eof:
+        # truncated streams are read as they are
+        return payload, 0
+    return memoryview(data), len(data)
+
+
+def _view(payload: bytes | str | memoryview) -> memoryview:
+    if isinstance(payload, str):
+        payload = bytes.fromhex(payload)
+    return memoryview(payload)
+
+
+def _parse_call(data: memoryview):
+    """Parses a decompressed call or creation payload, reads past its end are truncated."""
+    specifier = bytes(data[:5])
+    kind = data[5] if len(data) > 5 else 0
+    if kind == 0:
+        source_code_length = int.from_bytes(data[6:8], ENDIAN)
+        source_code = str(data[8:8 + source_code_length], 'utf-8')
+        offset = 8 + source_code_length
+        args_length = int.from_bytes(data[offset:offset + 2], ENDIAN)
+        args = deserialize(data[offset + 2:offset + 2 + args_length])
+        return ContractCreation(specifier, source_code, args)
+    contract_hash = data[6:38].hex()
+    method_length = data[38] if len(data) > 38 else 0
+    method = str(data[39:39 + method_length], 'utf-8')
+    args = deserialize(data[39 + method_length:])
+    return ContractCall(specifier, contract_hash, method, args)
 
 
 class ContractCall:
+    __slots__ = ('specifier', 'contract_hash', 'method', 'args')
+
     def __init__(self, specifier: bytes, contract_hash: str, method: str, args: tuple = ()):
         self.specifier = specifier
         self.contract_hash = contract_hash
@@ -209,27 +535,8 @@ class ContractCall:
         self.args = args
 
     @staticmethod
-    def from_payload(payload: bytes | str):
-        if isinstance(payload, str):
-            payload = bytes.fromhex(payload)
-        try:
-            payload = zlib.decompress(payload)
-        except zlib.error:
-            pass
-        buffer = BytesIO(payload)
-        specifier = buffer.read(5)
-        kind = int.from_bytes(buffer.read(1), ENDIAN)
-        if kind == 0:
-            source_code_length = int.from_bytes(buffer.read(2), ENDIAN)
-            source_code = buffer.read(source_code_length).decode()
-            args_length = int.from_bytes(buffer.read(2), ENDIAN)
-            args = deserialize(buffer.read(args_length))
-            return ContractCreation(specifier, source_code, args)
-        contract_hash = buffer.read(32).hex()
-        method_length = int.from_bytes(buffer.read(1), ENDIAN)
-        method = buffer.read(method_length).decode()
-        args = deserialize(buffer.read())
-        return ContractCall(specifier, contract_hash, method, args)
+    def from_payload(payload: bytes | str | memoryview, limit: int | None = MAX_PAYLOAD_SIZE):
+        return _parse_call(_decompress(_view(payload), limit)[0])
 
     def get_payload(self):
         method_bytes = self.method.encode()
@@ -237,8 +544,13 @@ class ContractCall:
         return self.specifier + bytes([1]) + bytes.fromhex(self.contract_hash) + bytes(
             [len(method_bytes)]) + method_bytes + args_bytes
 
+    def to_dict(self):
+        return {'specifier': self.specifier, 'contract_hash': self.contract_hash, 'method': self.method, 'args': self.args}
+
 
 class ContractCreation:
+    __slots__ = ('specifier', 'source_code', 'args')
+
     def __init__(self, specifier: bytes, source_code: str, args: tuple = tuple()):
         self.specifier = specifier
         self.source_code = source_code
@@ -250,41 +562,80 @@ class ContractCreation:
         payload = self.specifier + bytes([0]) + len(source_code_bytes).to_bytes(2, ENDIAN) + source_code_bytes + len(args_bytes).to_bytes(2, ENDIAN) + args_bytes
         return zlib.compress(payload)
 
+    def to_dict(self):
+        return {'specifier': self.specifier, 'source_code': self.source_code, 'args': self.args}
+
 
 class ContractCallList:
+    __slots__ = ('contract_calls',)
+
     def __init__(self, contract_calls: List[ContractCall | ContractCreation]):
         self.contract_calls = contract_calls
 
     @staticmethod
-    def from_payload(payload: bytes | str):
-        if isinstance(payload, str):
-            payload = bytes.fromhex(payload)
+    def from_payload(payload: bytes | str | memoryview, strict: bool = False):
+        """Parses a single call, or a serialized list of calls each of them possibly compressed.
+
+        Payloads are parsed with the strict rules, and parsed again with the legacy ones if they reject them,
+        unless strict is set, which it is for transactions of blocks from STRICT_PAYLOAD_BLOCK.
+        """
         try:
-            payload = zlib.decompress(payload)
-        except zlib.error:
-            pass
+            return ContractCallList._parse_strict(payload)
+        except Exception:
+            if strict:
+                raise
+        return ContractCallList._parse_legacy(payload)
+
+    @staticmethod
+    def _parse_strict(payload: bytes | str | memoryview):
+        # a single call or a list of bytes, in one pass without copying the payload,
+        # and at most MAX_PAYLOAD_SIZE bytes are decompressed in total
+        data, size = _decompress(_view(payload))
+        kind = data[0] if len(data) else 0
+        if kind != Type.list.value and kind != Type.tuple.value:
+            if Type.has_value(kind):
+                raise TypeError('Payload must be a call or a list of calls')
+            # calls start with their specifier, which is not a serialized type
+            return ContractCallList([_parse_call(_decompress(data, MAX_PAYLOAD_SIZE - size)[0])])
+        length, offset = deserialize_at(data, 1)
+        if type(length) is not int:
+            raise TypeError('Invalid length of the list of calls')
+        contract_calls = []
+        for _ in range(length):
+            item, offset = read_bytes_at(data, offset)
+            item, item_size = _decompress(item, MAX_PAYLOAD_SIZE - size)
+            size += item_size
+            contract_calls.append(_parse_call(item))
+        return ContractCallList(contract_calls)
+
+    @staticmethod
+    def _parse_legacy(payload: bytes | str | memoryview):
+        # the rules used before STRICT_PAYLOAD_BLOCK: any iterable is a list of calls, calls can be hex strings, sizes
+        # are not limited, and a TypeError of an invalid serialized type makes the whole payload a single call.
+        # They accept everything the strict ones accept, with the same result
+        data = _decompress(_view(payload), None)[0]
         try:
-            return ContractCallList([ContractCall.from_payload(contract_call) for contract_call in deserialize(payload)])
+            return ContractCallList([ContractCall.from_payload(contract_call, None) for contract_call in deserialize(data)])
         except TypeError as e:
             if str(e) != 'Invalid serialized type':
                 raise
-            return ContractCallList([ContractCall.from_payload(payload)])
+            return ContractCallList([ContractCall.from_payload(data, None)])
 
     def get_payload(self):
         return zlib.compress(serialize([contract_call.get_payload() for contract_call in self.contract_calls]))
 
 
 class LimitedContract(Contract):
-    _methods = {}
-
     def __init__(self, contract_hash: str):
-        if contract_hash not in ContractsCache.contracts:
+        context = ExecutionContext.current()
+        if contract_hash not in context.contracts:
             raise NotImplementedError(f'Contract <{contract_hash}> must be present in local contracts list')
-        assert contract_hash not in ContractsCache.contract_instances, 'cannot call itself'
-        ContractsCache.contract_instances.append(contract_hash)
-        contract = ContractsCache.contracts[contract_hash]
-        contract._caller_contract = Address(ContractsCache.current_contract_hash)
+        assert contract_hash not in context.contract_instances, 'cannot call itself'
+        context.contract_instances.append(contract_hash)
+        contract = context.contracts[contract_hash]
+        contract._caller_contract = Address(context.current_contract_hash)
         super().__init__(contract_hash, contract._variables, contract._methods)
+        self._dirty = contract._dirty
 
     def export(self, func):
         raise Exception('Cannot export')
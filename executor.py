@@ -0,0 +1,201 @@
+import asyncio
+import pickle
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from os import environ
+from typing import Dict
+
+from dvm.contract import Block, Contract, ContractCall, ExecutionContext, StorageMap
+from dvm.serializer import deserialize, serialize
+from dvm.state import Journal
+from dvm.timeout import timeout
+from dvm.vm import DVM, contract_globals, instantiate_contract
+
+
+# contracts kept instantiated by each worker
+WORKER_CACHE_SIZE = int(environ.get('DVM_WORKER_CACHE_SIZE', 64))
+
+
+class Fallback:
+    """Returned by the workers for calls that need the database, which the caller then runs itself."""
+
+
+class NotCached:
+    """Returned by a worker asked to run a contract it does not have, the caller then sends its source code and state."""
+
+
+class WorkerUnavailable(Exception):
+    ...
+
+
+# set in a worker when the call used something only the main process has
+_needs_main_process = False
+# (contract hash, state block, generation) -> contract instantiated by the worker
+_contracts: Dict[tuple, Contract] = OrderedDict()
+
+
+async def _unavailable(*args, **kwargs):
+    global _needs_main_process
+    _needs_main_process = True
+    raise WorkerUnavailable()
+
+
+def _init_worker():
+    contract_globals['load_contract'] = _unavailable
+    contract_globals['get_block'] = _unavailable
+
+
+def _ready():
+    return True
+
+
+def _execute(key: tuple, source_code: str | None, encoded_state: dict | None, method: str, kwargs: dict, seconds: float):
+    global _needs_main_process
+    _needs_main_process = False
+    contract_hash = key[0]
+    context = ExecutionContext().activate()
+    contract = _contracts.get(key)
+    if contract is not None:
+        _contracts.move_to_end(key)
+    elif source_code is None:
+        return NotCached
+    else:
+        contract = instantiate_contract(contract_hash, source_code, encoded_state)
+        if key[1] is not None:
+            _contracts[key] = contract
+            while len(_contracts) > WORKER_CACHE_SIZE:
+                _contracts.popitem(last=False)
+    context.contracts[contract_hash] = contract
+    context.current_contract_hash = contract_hash
+    context.contract_instances = [contract_hash]
+    # changes made by the method are reverted so the cached contract keeps the persisted state
+    journal = context.journal = Journal()
+    try:
+        result = asyncio.run(timeout(seconds, contract._methods[method], **kwargs))
+    except Exception as e:
+        # contract code may catch these, so they are checked in any case
+        if _needs_main_process or context.storage_misses:
+            return Fallback
+        try:
+            pickle.dumps(e)
+        except Exception:
+            # exceptions defined by contracts cannot be sent back
+            raise RuntimeError(f'{e.__class__.__name__}: {str(e)}') from None
+        raise
+    finally:
+        journal.revert(context.contracts)
+        contract._dirty.clear()
+    if _needs_main_process or context.storage_misses:
+        return Fallback
+    return result
+
+
+async def _execute_calls(dvm: DVM, calls: list, block_no: int):
+    return [await dvm.execute_call(call, block_no) for call in calls]
+
+
+def _execute_group(contract_hash: str, source_code: str, encoded_state: dict, calls: list, block: Block):
+    """Executes in order the calls of a block to a contract, returns their results and the encoded changed variables."""
+    global _needs_main_process
+    _needs_main_process = False
+    context = ExecutionContext(block=block).activate()
+    contract = instantiate_contract(contract_hash, source_code, encoded_state)
+    context.contracts[contract_hash] = contract
+    dvm = DVM(None)
+    # missed storage entries can only be loaded by the main process
+    dvm.load_storage = _unavailable
+    try:
+        results = asyncio.run(_execute_calls(dvm, calls, block['id']))
+    except Exception:
+        if _needs_main_process:
+            return Fallback
+        raise
+    if _needs_main_process:
+        return Fallback
+    # only empty storage maps can be written here, since every other entry is missing, their entries are not sent
+    # back, so the main process runs the calls instead
+    if any(storage_map._touched for storage_map in contract._variables.storage_maps.values()):
+        return Fallback
+    variables = {
+        k: serialize(contract._variables[k]).hex() for k in contract._dirty if type(contract._variables[k]) is not StorageMap
+    }
+    return results, variables
+
+
+class ContractExecutor:
+    """Runs contract methods, or the calls of a block, in a pool of worker processes.
+
+    Workers keep the contracts they instantiated, keyed by contract hash and block of their state, and get the source
+    code and the encoded state of a contract only when they do not have it. Their storage maps have no entries loaded,
+    so the results of the methods they run only depend on the state written at that block.
+    Entries of storage maps, other contracts and blocks are not available in the workers, methods using them return
+    Fallback and have to be run in the main process.
+    """
+
+    def __init__(self, workers: int, seconds: float):
+        self.workers = workers
+        self.seconds = seconds
+        self.pool = ProcessPoolExecutor(workers, initializer=_init_worker)
+        # bumped when states are rolled back, since the states of the rolled back blocks can be written again
+        self.generation = 0
+
+    async def start(self):
+        # workers are started before serving requests
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.pool, _ready) for _ in range(self.workers)))
+
+    async def run(self, contract: Contract, method: str, kwargs: dict):
+        if contract._source_code is None or contract._encoded_state is None:
+            return Fallback
+        loop = asyncio.get_running_loop()
+        key = (contract._contract_hash, contract._state_block, self.generation)
+        if contract._state_block is not None:
+            result = await loop.run_in_executor(self.pool, _execute, key, None, None, method, kwargs, self.seconds)
+            if result is not NotCached:
+                return result
+        return await loop.run_in_executor(
+            self.pool, _execute, key, contract._source_code, contract._encoded_state, method, kwargs, self.seconds
+        )
+
+    def invalidate(self):
+        """Makes the workers instantiate again every contract, after a rollback of states."""
+        self.generation += 1
+
+    async def execute_block(self, contracts: Dict[str, Contract], calls: list, block: Block):
+        """Executes the calls of a block in parallel, one worker per called contract.
+
+        Calls to different contracts commute as long as each of them only touches its own contract, so the block is run
+        again in the main process (Fallback is returned) when any call loads another contract, reads a block or misses
+        a storage entry. Blocks creating contracts are not run in parallel, since their gas depends on the other calls.
+        """
+        groups = {}
+        for i, call in enumerate(calls):
+            contract_call = call['contract_call']
+            if not isinstance(contract_call, ContractCall) or contract_call.contract_hash not in contracts:
+                return Fallback
+            groups.setdefault(contract_call.contract_hash, []).append(i)
+        if len(groups) < 2 or any(contracts[contract_hash]._source_code is None for contract_hash in groups):
+            return Fallback
+        loop = asyncio.get_running_loop()
+        outcomes = await asyncio.gather(*(
+            loop.run_in_executor(
+                self.pool, _execute_group,
+                contract_hash, contracts[contract_hash]._source_code, contracts[contract_hash]._encoded_state,
+                [calls[i] for i in indexes], Block(block)
+            )
+            for contract_hash, indexes in groups.items()
+        ))
+        if any(outcome is Fallback for outcome in outcomes):
+            return Fallback
+        results = [None] * len(calls)
+        for (contract_hash, indexes), (group_results, variables) in zip(groups.items(), outcomes):
+            for i, result in zip(indexes, group_results):
+                results[i] = result
+            contract = contracts[contract_hash]
+            for k, v in variables.items():
+                contract._variables[k] = deserialize(bytes.fromhex(v))
+                contract._dirty.add(k)
+        return results
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,144 @@
+import asyncio
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+from typing import Dict, List, Tuple
+
+from denaro import Database
+from denaro.constants import SMALLEST
+from denaro.helpers import sha256, point_to_string
+from denaro.transactions import CoinbaseTransaction, Transaction
+
+from dvm.contract import ContractCallList, DVMTransaction, STRICT_PAYLOAD_BLOCK
+
+# it will change before the stable release
+DVM_ADDRESS = 'DsmArTjpJNuEBuHB2x4f14cDifdduTtu2CR1BMs1P5RcF'
+
+# processes decoding the outputs spent by the inputs, 0 decodes them on the event loop
+RECOVERY_WORKERS = int(os.environ.get('DVM_RECOVERY_WORKERS', os.cpu_count() or 1))
+RECOVERY_BATCH_SIZE = 64
+SPENT_OUTPUTS_CACHE_SIZE = 65536
+
+# (tx_hash, index) of an input -> address that owns the spent output and its amount
+spent_outputs_cache: Dict[Tuple[str, int], Tuple[str, Decimal]] = OrderedDict()
+recovery_pool: ProcessPoolExecutor = None
+
+
+class TransactionMetadata:
+    """Values of a transaction shared by all its DVM calls, computed once instead of for each output."""
+
+    __slots__ = ('hash', 'hex_length', 'fees', 'sender', 'fee_rate')
+
+    def __init__(self, tx_hash: str, hex_length: int, fees: Decimal, sender: str):
+        self.hash = tx_hash
+        self.hex_length = hex_length
+        self.fees = fees
+        self.sender = sender
+        self.fee_rate = (fees / hex_length / 2) if fees > 0 else (1 / Decimal(SMALLEST))
+
+
+async def _recover_outputs(related: List[Tuple[str, List[int]]]) -> List[List[Tuple[str, Decimal]]]:
+    outputs = []
+    for tx_hex, indexes in related:
+        tx = await Transaction.from_hex(tx_hex, False)
+        outputs.append([(point_to_string(tx.outputs[index].public_key), tx.outputs[index].amount) for index in indexes])
+    return outputs
+
+
+def recover_outputs(related: List[Tuple[str, List[int]]]) -> List[List[Tuple[str, Decimal]]]:
+    """Decodes the related transactions and returns the addresses and amounts of the spent outputs, it runs in the recovery pool."""
+    return asyncio.run(_recover_outputs(related))
+
+
+async def get_spent_outputs(database: Database, tx_inputs: list) -> Dict[Tuple[str, int], Tuple[str, Decimal]]:
+    """Recovers the addresses and amounts of the outputs spent by the inputs of a whole block at once, using the recovery pool."""
+    global recovery_pool
+    # the cache is shared with the concurrent prefetch tasks, which can evict entries while this one awaits
+    spent_outputs = {}
+    missing = {}
+    for tx_input in tx_inputs:
+        key = (tx_input.tx_hash, tx_input.index)
+        output = spent_outputs_cache.get(key)
+        if output is not None:
+            spent_outputs[key] = output
+        else:
+            missing.setdefault(tx_input.tx_hash, set()).add(tx_input.index)
+    if missing:
+        async with database.pool.acquire() as connection:
+            rows = await connection.fetch('SELECT tx_hash, tx_hex FROM transactions WHERE tx_hash = ANY($1)', list(missing))
+        txs_hex = {row['tx_hash']: row['tx_hex'] for row in rows}
+        tx_hashes = list(missing)
+        related = [(txs_hex[tx_hash], sorted(missing[tx_hash])) for tx_hash in tx_hashes]
+        batches = [related[j:j + RECOVERY_BATCH_SIZE] for j in range(0, len(related), RECOVERY_BATCH_SIZE)]
+        if RECOVERY_WORKERS > 0:
+            if recovery_pool is None:
+                recovery_pool = ProcessPoolExecutor(RECOVERY_WORKERS)
+            loop = asyncio.get_running_loop()
+            results = await asyncio.gather(*(loop.run_in_executor(recovery_pool, recover_outputs, batch) for batch in batches))
+        else:
+            results = [await _recover_outputs(batch) for batch in batches]
+        for tx_hash, (_, indexes), outputs in zip(tx_hashes, related, (outputs for result in results for outputs in result)):
+            for index, output in zip(indexes, outputs):
+                spent_outputs[(tx_hash, index)] = spent_outputs_cache[(tx_hash, index)] = output
+        while len(spent_outputs_cache) > SPENT_OUTPUTS_CACHE_SIZE:
+            spent_outputs_cache.popitem(last=False)
+    return {(tx_input.tx_hash, tx_input.index): spent_outputs[(tx_input.tx_hash, tx_input.index)] for tx_input in tx_inputs}
+
+
+async def prepare_block(database: Database, block_no: int):
+    """Fetches a block and decodes its DVM calls, everything that does not depend on the DVM state.
+
+    The hash of the previous block is returned too, the daemon compares it with the one it executed to detect reorgs.
+    """
+    block = await database.get_block_by_id(block_no)
+    if block is None:
+        return None
+    block_hash = block['hash']
+    # transactions with only one input can be filtered by the query.
+    # a kind of multisig could be implemented by making able to use more input addresses and provide a list of them to the smart contract
+    async with database.pool.acquire() as connection:
+        rows = await connection.fetch('SELECT tx_hash, tx_hex FROM transactions WHERE block_hash = $1 AND $2 = ANY(outputs_addresses)', block_hash, DVM_ADDRESS)
+        previous_hash = await connection.fetchval('SELECT hash FROM blocks WHERE id = $1', block_no - 1)
+    # hashes and sizes come from the database, so transactions are not serialized again
+    txs = [(row['tx_hash'], len(row['tx_hex']), await Transaction.from_hex(row['tx_hex'], False)) for row in rows]
+    spent_outputs = await get_spent_outputs(database, [tx_input for _, _, tx in txs if not isinstance(tx, CoinbaseTransaction) for tx_input in tx.inputs])
+    calls = []
+    for tx_hash, hex_length, tx in txs:
+        if isinstance(tx, CoinbaseTransaction):
+            continue
+        inputs = [spent_outputs[(tx_input.tx_hash, tx_input.index)] for tx_input in tx.inputs]
+        if len({sender for sender, _ in inputs}) != 1:
+            print('Skipping transaction because too many input addresses')
+            continue
+        if any(output.address == DVM_ADDRESS for output in tx.outputs):
+            payload = tx.message
+            try:
+                contract_call_list = ContractCallList.from_payload(
+                    payload, STRICT_PAYLOAD_BLOCK is not None and block_no >= STRICT_PAYLOAD_BLOCK
+                )
+            except Exception as e:
+                print('Invalid payload:', e)
+                continue
+            # fees are computed from the spent outputs, as Transaction.get_fees does with a query for each input
+            fees = sum(amount for _, amount in inputs) - sum(output.amount for output in tx.outputs)
+            metadata = TransactionMetadata(tx_hash, hex_length, fees, inputs[0][0])
+            dvm_tx = DVMTransaction(metadata.hash, tx.outputs)
+            creation_prefix = bytes.fromhex(block_hash) + bytes.fromhex(metadata.hash)
+            for index, output in enumerate(tx.outputs):
+                if output.address == DVM_ADDRESS:
+                    # fixme rename
+                    # fixme change way it is created
+                    contract_creation_hash = sha256(creation_prefix + bytes([index]))
+                    calls.append({
+                        'contract_call': contract_call_list.contract_calls[index],
+                        'tx_hash': metadata.hash,
+                        'dvm_tx': dvm_tx,
+                        'output_index': index,
+                        # fixme show only if deploying a contract
+                        'contract_creation_hash': contract_creation_hash,
+                        'sender': metadata.sender,
+                        'fees': output.amount,
+                        'fee_rate': metadata.fee_rate
+                    })
+    return block, calls, previous_hash
@@ -0,0 +1,14 @@
+-- columns and tables added to schema.sql after it was first applied, the following migrations index them
+
+-- rows written before state diffs existed are full states
+ALTER TABLE dvm_state ADD COLUMN IF NOT EXISTS checkpoint BOOLEAN NOT NULL DEFAULT TRUE;
+
+-- top-level dict variables of contracts when DVM_STORAGE_MODE is keyed, a NULL value marks a deleted key
+CREATE TABLE IF NOT EXISTS dvm_storage (
+	contract_hash CHAR(64) NOT NULL REFERENCES dvm(contract_hash) ON DELETE CASCADE,
+	var TEXT NOT NULL,
+	key TEXT NOT NULL,
+	block_no INT REFERENCES blocks(id) ON DELETE CASCADE,
+	position INT,
+	value TEXT
+);
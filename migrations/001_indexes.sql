@@ -0,0 +1,22 @@
+-- indexes for the daemon resume point, the latest and historical state lookups and the per contract queries,
+-- and the latest state pointer table maintained by the daemon
+
+CREATE INDEX IF NOT EXISTS dvm_state_block_idx ON dvm_state (block_no DESC);
+CREATE INDEX IF NOT EXISTS dvm_state_contract_block_idx ON dvm_state (contract_hash, block_no DESC);
+CREATE INDEX IF NOT EXISTS dvm_storage_key_idx ON dvm_storage (contract_hash, var, key, block_no DESC);
+CREATE INDEX IF NOT EXISTS dvm_storage_block_idx ON dvm_storage (block_no);
+CREATE INDEX IF NOT EXISTS dvm_transactions_contract_idx ON dvm_transactions (contract_hash);
+CREATE INDEX IF NOT EXISTS dvm_events_contract_name_idx ON dvm_events (contract_hash, name);
+CREATE INDEX IF NOT EXISTS dvm_events_tx_idx ON dvm_events (tx_hash, output_index);
+
+CREATE TABLE IF NOT EXISTS dvm_latest_state (
+	contract_hash CHAR(64) PRIMARY KEY REFERENCES dvm(contract_hash) ON DELETE CASCADE,
+	block_no INT NOT NULL,
+	checkpoint_block_no INT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS dvm_latest_state_block_idx ON dvm_latest_state (block_no);
+
+INSERT INTO dvm_latest_state (contract_hash, block_no, checkpoint_block_no)
+SELECT contract_hash, MAX(block_no), MAX(block_no) FILTER (WHERE checkpoint) FROM dvm_state GROUP BY contract_hash
+ON CONFLICT (contract_hash) DO NOTHING;
@@ -0,0 +1,39 @@
+-- blocks of the created contracts and of the transactions, to roll them back on reorgs,
+-- and the hashes of the executed blocks, assumed to be the ones currently in the chain
+
+ALTER TABLE dvm ADD COLUMN IF NOT EXISTS block_no INT;
+ALTER TABLE dvm_transactions ADD COLUMN IF NOT EXISTS block_no INT;
+
+UPDATE dvm d SET block_no = s.block_no
+FROM (SELECT contract_hash, MIN(block_no) AS block_no FROM dvm_state GROUP BY contract_hash) s
+WHERE d.contract_hash = s.contract_hash AND d.block_no IS NULL;
+
+-- contracts without any state row get the block of their creation transaction
+UPDATE dvm d SET block_no = b.id
+FROM transactions t JOIN blocks b ON b.hash = t.block_hash
+WHERE t.tx_hash = d.creation_transaction AND d.block_no IS NULL;
+
+UPDATE dvm_transactions d SET block_no = b.id
+FROM transactions t JOIN blocks b ON b.hash = t.block_hash
+WHERE t.tx_hash = d.tx_hash AND d.block_no IS NULL;
+
+-- as declared in schema.sql, it fails if a row could not be backfilled
+ALTER TABLE dvm ALTER COLUMN block_no SET NOT NULL;
+ALTER TABLE dvm_transactions ALTER COLUMN block_no SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS dvm_block_idx ON dvm (block_no);
+CREATE INDEX IF NOT EXISTS dvm_transactions_block_idx ON dvm_transactions (block_no);
+
+CREATE TABLE IF NOT EXISTS dvm_blocks (
+	block_no INT PRIMARY KEY,
+	block_hash CHAR(64) NOT NULL
+);
+
+-- blocks which changed no state write no dvm_state row, the last executed block is the latest one with any dvm row
+INSERT INTO dvm_blocks (block_no, block_hash)
+SELECT id, hash FROM blocks WHERE id <= GREATEST(
+	(SELECT MAX(block_no) FROM dvm_state),
+	(SELECT MAX(block_no) FROM dvm_transactions),
+	(SELECT MAX(block_no) FROM dvm)
+)
+ON CONFLICT (block_no) DO NOTHING;
@@ -0,0 +1,4 @@
+-- transactions of a contract are listed from the latest block, which the index on the contract alone does not order
+
+CREATE INDEX IF NOT EXISTS dvm_transactions_contract_block_idx ON dvm_transactions (contract_hash, block_no DESC);
+DROP INDEX IF EXISTS dvm_transactions_contract_idx;
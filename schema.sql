@@ -6,23 +6,56 @@ drop table dvm_transactions;
 CREATE TABLE IF NOT EXISTS dvm (
 	contract_hash CHAR(64) UNIQUE,
 	creation_transaction CHAR(64) NOT NULL REFERENCES transactions(tx_hash) ON DELETE CASCADE,
-	source_code BYTEA NOT NULL
+	source_code BYTEA NOT NULL,
+	block_no INT NOT NULL
 );
 
+CREATE INDEX IF NOT EXISTS dvm_block_idx ON dvm (block_no);
+
 CREATE TABLE IF NOT EXISTS dvm_state (
 	contract_hash CHAR(64) NOT NULL REFERENCES dvm(contract_hash) ON DELETE CASCADE,
 	block_no INT REFERENCES blocks(id) ON DELETE CASCADE,
-	state JSONB NOT NULL
+	state JSONB NOT NULL,
+	checkpoint BOOLEAN NOT NULL DEFAULT TRUE
+);
+
+CREATE INDEX IF NOT EXISTS dvm_state_block_idx ON dvm_state (block_no DESC);
+CREATE INDEX IF NOT EXISTS dvm_state_contract_block_idx ON dvm_state (contract_hash, block_no DESC);
+
+-- block of the latest change and of the latest checkpoint of every contract, written by the daemon with each block
+CREATE TABLE IF NOT EXISTS dvm_latest_state (
+	contract_hash CHAR(64) PRIMARY KEY REFERENCES dvm(contract_hash) ON DELETE CASCADE,
+	block_no INT NOT NULL,
+	checkpoint_block_no INT NOT NULL
 );
 
+CREATE INDEX IF NOT EXISTS dvm_latest_state_block_idx ON dvm_latest_state (block_no);
+
+-- top-level dict variables of contracts when DVM_STORAGE_MODE is keyed, a NULL value marks a deleted key
+CREATE TABLE IF NOT EXISTS dvm_storage (
+	contract_hash CHAR(64) NOT NULL REFERENCES dvm(contract_hash) ON DELETE CASCADE,
+	var TEXT NOT NULL,
+	key TEXT NOT NULL,
+	block_no INT REFERENCES blocks(id) ON DELETE CASCADE,
+	position INT,
+	value TEXT
+);
+
+CREATE INDEX IF NOT EXISTS dvm_storage_key_idx ON dvm_storage (contract_hash, var, key, block_no DESC);
+CREATE INDEX IF NOT EXISTS dvm_storage_block_idx ON dvm_storage (block_no);
+
 CREATE TABLE IF NOT EXISTS dvm_transactions (
     contract_hash CHAR(64) NOT NULL REFERENCES dvm(contract_hash) ON DELETE CASCADE,
 	tx_hash CHAR(64) NOT NULL REFERENCES transactions(tx_hash) ON DELETE CASCADE,
 	output_index SMALLINT NOT NULL,
 	payload TEXT NOT NULL,
+	block_no INT NOT NULL,
 	UNIQUE (tx_hash, output_index)
 );
 
+CREATE INDEX IF NOT EXISTS dvm_transactions_contract_block_idx ON dvm_transactions (contract_hash, block_no DESC);
+CREATE INDEX IF NOT EXISTS dvm_transactions_block_idx ON dvm_transactions (block_no);
+
 CREATE TABLE IF NOT EXISTS dvm_events (
 	tx_hash CHAR(64) NOT NULL,
 	output_index SMALLINT NOT NULL,
@@ -30,4 +63,13 @@ CREATE TABLE IF NOT EXISTS dvm_events (
 	name TEXT NOT NULL,
 	args JSONB NOT NULL,
 	FOREIGN KEY (tx_hash, output_index) REFERENCES dvm_transactions (tx_hash, output_index)
-);
\ No newline at end of file
+);
+
+CREATE INDEX IF NOT EXISTS dvm_events_contract_name_idx ON dvm_events (contract_hash, name);
+CREATE INDEX IF NOT EXISTS dvm_events_tx_idx ON dvm_events (tx_hash, output_index);
+
+-- hashes of the blocks executed by the daemon, to detect reorgs of the chain and to resume from the last one
+CREATE TABLE IF NOT EXISTS dvm_blocks (
+	block_no INT PRIMARY KEY,
+	block_hash CHAR(64) NOT NULL
+);
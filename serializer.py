@@ -1,4 +1,7 @@
 import io
+import os
+import struct
+import sys
 from decimal import Decimal
 
 from enum import Enum, auto
@@ -130,12 +133,174 @@ def _deserialize(stream: io.BytesIO):
             return tuple(_deserialize(stream) for _ in range(length))
 
 
-def deserialize(data: bytes):
+def reference_deserialize(data: bytes):
     return _deserialize(io.BytesIO(data))
 
 
-def serialize(data) -> bytes:
+def reference_serialize(data) -> bytes:
     to = io.BytesIO()
     _serialize(to, data)
     to.seek(0)
     return to.read()
+
+
+# fast engine, it produces the same bytes as the reference one
+
+_INT = Type.int.value
+_STR = Type.str.value
+_BOOL = Type.bool.value
+_BYTES = Type.bytes.value
+_DECIMAL = Type.Decimal.value
+_DICT = Type.dict.value
+_LIST = Type.list.value
+_TUPLE = Type.tuple.value
+
+_INT_HEADER = struct.Struct("<BH")  # type and uint16 length of an int
+_TRUE = bytes([_BOOL, 1])
+_FALSE = bytes([_BOOL, 0])
+
+
+def _encode_int(value: int) -> bytes:
+    length = (value.bit_length() + 7) // 8 * 2
+    if length > 0xFFFF:
+        raise OverflowError("int too big to convert")
+    return _INT_HEADER.pack(_INT, length) + value.to_bytes(length, "little", signed=True)
+
+
+# most lengths are small, so their encoding is precomputed
+_LENGTHS = [_encode_int(n) for n in range(4096)]
+
+
+def _encode_length(value: int) -> bytes:
+    return _LENGTHS[value] if value < 4096 else _encode_int(value)
+
+
+def fast_serialize(data) -> bytes:
+    out = bytearray()
+    stack = [data]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        value = pop()
+        t = type(value)
+        if t is str:
+            as_bytes = value.encode("utf-8")
+            if len(as_bytes) > 2 ** 32 - 1:
+                raise ValueError(f"String length cannot be larger than {2 ** 32 - 1}")
+            out.append(_STR)
+            out += _encode_length(len(as_bytes))
+            out += as_bytes
+        elif t is int:
+            out += _LENGTHS[value] if 0 <= value < 4096 else _encode_int(value)
+        elif t is Decimal:
+            if value != +value:
+                raise ValueError("Decimal precision must be 28 or lower")
+            as_bytes = str(remove_exponent(value)).encode("utf-8")
+            if len(as_bytes) > 2 ** 32 - 1:
+                raise ValueError(f"Decimal string length cannot be larger than {2 ** 32 - 1}")
+            out.append(_DECIMAL)
+            out += _encode_length(len(as_bytes))
+            out += as_bytes
+        elif t is dict:
+            out.append(_DICT)
+            out += _encode_length(len(value))
+            for key, item in reversed(value.items()):
+                push(item)
+                push(key)
+        elif t is list or t is tuple:
+            out.append(_LIST if t is list else _TUPLE)
+            out += _encode_length(len(value))
+            stack.extend(reversed(value))
+        elif t is bool:
+            out += _TRUE if value else _FALSE
+        elif t is bytes:
+            if len(value) > 2 ** 32 - 1:
+                raise ValueError(f"Bytes length cannot be larger than {2 ** 32 - 1}")
+            out.append(_BYTES)
+            out += _encode_length(len(value))
+            out += value
+        else:
+            raise TypeError(f"Type {t.__name__} for value {value!r} is unsupported")
+    return bytes(out)
+
+
+def _read(data: memoryview, offset: int, length, end: int):
+    # mirrors BytesIO.read: a negative length reads everything and reads past the end are truncated
+    if type(length) is not int and type(length) is not bool:
+        raise TypeError(f"argument should be integer or None, not '{type(length).__name__}'")
+    if not -sys.maxsize - 1 <= length <= sys.maxsize:
+        raise OverflowError("Python int too large to convert to C ssize_t")
+    stop = end if length < 0 else min(offset + length, end)
+    return data[offset:stop], stop
+
+
+def _fast_deserialize(data: memoryview, offset: int, end: int):
+    t = data[offset] if offset < end else 0
+    offset += 1
+    if t == _INT:
+        length = int.from_bytes(data[offset:offset + 2], "little")
+        offset = min(offset + 2, end)
+        stop = min(offset + length, end)
+        return int.from_bytes(data[offset:stop], "little", signed=True), stop
+    elif t == _STR:
+        length, offset = _fast_deserialize(data, offset, end)
+        value, offset = _read(data, offset, length, end)
+        return str(value, "utf-8"), offset
+    elif t == _DICT:
+        length, offset = _fast_deserialize(data, offset, end)
+        result = {}
+        for _ in range(length):
+            key, offset = _fast_deserialize(data, offset, end)
+            value, offset = _fast_deserialize(data, offset, end)
+            result[key] = value
+        return result, offset
+    elif t == _DECIMAL:
+        length, offset = _fast_deserialize(data, offset, end)
+        value, offset = _read(data, offset, length, end)
+        return Decimal(str(value, "utf-8")), offset
+    elif t == _LIST or t == _TUPLE:
+        length, offset = _fast_deserialize(data, offset, end)
+        result = []
+        for _ in range(length):
+            value, offset = _fast_deserialize(data, offset, end)
+            result.append(value)
+        return (result if t == _LIST else tuple(result)), offset
+    elif t == _BOOL:
+        stop = min(offset + 1, end)
+        return bool(int.from_bytes(data[offset:stop], "little")), stop
+    elif t == _BYTES:
+        length, offset = _fast_deserialize(data, offset, end)
+        value, offset = _read(data, offset, length, end)
+        return bytes(value), offset
+    raise TypeError("Invalid serialized type")
+
+
+def fast_deserialize(data: bytes):
+    data = memoryview(data)
+    return _fast_deserialize(data, 0, len(data))[0]
+
+
+def deserialize_at(data: memoryview, offset: int):
+    """Deserializes the value starting at offset, returns it with the offset of what follows it."""
+    return _fast_deserialize(data, offset, len(data))
+
+
+def read_bytes_at(data: memoryview, offset: int):
+    """Like deserialize_at for a bytes value, but returns a view of data instead of a copy."""
+    if offset >= len(data) or data[offset] != _BYTES:
+        raise TypeError("Expected serialized bytes")
+    length, offset = _fast_deserialize(data, offset + 1, len(data))
+    return _read(data, offset, length, len(data))
+
+
+# DVM_SERIALIZER=reference switches back to the original implementation
+SERIALIZER_ENGINE = os.environ.get("DVM_SERIALIZER", "fast")
+
+if SERIALIZER_ENGINE == "reference":
+    serialize, deserialize = reference_serialize, reference_deserialize
+else:
+    serialize, deserialize = fast_serialize, fast_deserialize
+
+
+def serialized_size(data) -> int:
+    return len(serialize(data))
@@ -1,29 +1,214 @@
-from fastapi import FastAPI
+import asyncio
+import json
+import os
+from collections import OrderedDict
+from os import environ
+from typing import Dict
+
+from fastapi import FastAPI, HTTPException, Query
 from starlette.requests import Request
 
 from denaro import Database
 from daemon import DVM
 from contract import ContractCall
+from dvm.contract import Contract, ExecutionContext
+from dvm.executor import ContractExecutor, Fallback
+from dvm.serializer import deserialize
+from dvm.state import Journal
+
+# number of contracts kept instantiated and seconds between checks for new states
+CACHE_SIZE = int(environ.get('DVM_SERVER_CACHE_SIZE', 256))
+CACHE_POLL_INTERVAL = float(environ.get('DVM_SERVER_POLL_INTERVAL', 1))
+MAX_PAGE_SIZE = 100
+# reads accepted by a single request of the batch endpoint
+MAX_BATCH_SIZE = int(environ.get('DVM_SERVER_MAX_BATCH_SIZE', 100))
+# processes running view methods, 0 runs them in the server process, and seconds a method can run
+SERVER_WORKERS = int(environ.get('DVM_SERVER_WORKERS', os.cpu_count() or 1))
+WORKER_TIMEOUT = float(environ.get('DVM_WORKER_TIMEOUT', 1))
 
 app = FastAPI()
 dvm: DVM = None
 
 
+class ContractCache:
+    """Least recently used contracts instantiated from the latest state, dropped when their latest state changes.
+
+    Each contract is checked against the block dvm_latest_state points to, which a new state or a rollback changes.
+    Every contract is dropped when the daemon rolls back blocks after a reorg of the chain.
+    """
+
+    def __init__(self, dvm: DVM, size: int, executor: ContractExecutor = None):
+        self.dvm = dvm
+        self.size = size
+        # its workers keep instantiated contracts too
+        self.executor = executor
+        self.contracts: Dict[str, Contract] = OrderedDict()
+        self.loading: Dict[str, asyncio.Task] = {}
+        # last block executed by the daemon when the cache was checked, and its hash
+        self.block_no = 0
+        self.block_hash: str | None = None
+        self.watch_task: asyncio.Task | None = None
+
+    async def get(self, contract_hash: str) -> Contract | None:
+        if contract_hash in self.contracts:
+            self.contracts.move_to_end(contract_hash)
+            return self.contracts[contract_hash]
+        # concurrent requests for the same contract wait for the same load
+        task = self.loading.get(contract_hash)
+        if task is None:
+            task = self.loading[contract_hash] = asyncio.create_task(self._load(contract_hash))
+        return await asyncio.shield(task)
+
+    async def _load(self, contract_hash: str) -> Contract | None:
+        task = asyncio.current_task()
+        try:
+            contract = (await self.dvm.get_contracts([contract_hash])).get(contract_hash)
+            # a load that has been invalidated while running is returned but not cached
+            if contract is not None and self.loading.get(contract_hash) is task:
+                self.contracts[contract_hash] = contract
+                while len(self.contracts) > self.size:
+                    self.contracts.popitem(last=False)
+            return contract
+        finally:
+            if self.loading.get(contract_hash) is task:
+                del self.loading[contract_hash]
+
+    def invalidate(self, contract_hash: str):
+        self.contracts.pop(contract_hash, None)
+        self.loading.pop(contract_hash, None)
+
+    async def start(self):
+        async with self.dvm.database.pool.acquire() as connection:
+            self.block_no, self.block_hash = await self.get_tip(connection)
+        # the task is kept so that it is not garbage collected while pending, and to cancel it on shutdown
+        self.watch_task = asyncio.create_task(self.watch())
+
+    async def stop(self):
+        if self.watch_task is not None:
+            self.watch_task.cancel()
+            try:
+                await self.watch_task
+            except asyncio.CancelledError:
+                pass
+            self.watch_task = None
+
+    @staticmethod
+    async def get_tip(connection) -> tuple:
+        res = await connection.fetchrow('SELECT block_no, block_hash FROM dvm_blocks ORDER BY block_no DESC LIMIT 1')
+        return (res['block_no'], res['block_hash']) if res else (0, None)
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(CACHE_POLL_INTERVAL)
+            # contracts loaded while checking are checked the next time
+            cached = dict(self.contracts)
+            try:
+                async with self.dvm.database.pool.acquire() as connection:
+                    block_no, block_hash = await self.get_tip(connection)
+                    # the block checked last has been rolled back, or replaced, if its hash is not the same anymore
+                    rolled_back = await connection.fetchval(
+                        'SELECT block_hash FROM dvm_blocks WHERE block_no = $1', self.block_no
+                    ) != self.block_hash
+                    # a rollback can move the pointer of a contract back, to a block before or after the one checked
+                    rows = await connection.fetch(
+                        'SELECT contract_hash, block_no FROM dvm_latest_state WHERE contract_hash = ANY($1)',
+                        list(cached)
+                    )
+            except Exception as e:
+                print(f'Could not check for new contract states because of {e.__class__.__name__}: {str(e)}')
+                continue
+            if rolled_back:
+                self.contracts.clear()
+                self.loading.clear()
+                self.dvm.historical_states.clear()
+                if self.executor is not None:
+                    self.executor.invalidate()
+            state_blocks = dict(rows)
+            # contracts are dropped when the state they have been loaded from is not the latest one anymore
+            for contract_hash, contract in cached.items():
+                if self.contracts.get(contract_hash) is contract and state_blocks.get(contract_hash) != contract._state_block:
+                    self.invalidate(contract_hash)
+            self.block_no, self.block_hash = block_no, block_hash
+
+
+contract_cache: ContractCache = None
+# methods run one at a time since the contracts cache is global
+execution_lock = asyncio.Lock()
+
+
+executor: ContractExecutor | None = None
+
+
+async def get_block_no(at_block: str) -> int:
+    """Parses the at_block query parameter, the block must have been executed by the daemon."""
+    try:
+        block_no = int(at_block)
+    except ValueError:
+        raise HTTPException(400, 'at_block must be a block number')
+    async with dvm.database.pool.acquire() as connection:
+        executed = await connection.fetchval('SELECT 1 FROM dvm_blocks WHERE block_no = $1', block_no)
+    if not executed:
+        raise HTTPException(404, f'Block {block_no} has not been executed')
+    return block_no
+
+
+async def run_read(contract: Contract, method: str, kwargs: dict, block_no: int = None):
+    """Runs a view method, contracts loaded by it are read at block_no like the contract itself, the latest state if None."""
+    if executor is not None:
+        result = await executor.run(contract, method, kwargs)
+        if result is not Fallback:
+            return result
+    # each request has its own context, the lock is still needed since cached contracts are shared between requests
+    async with execution_lock:
+        context = ExecutionContext().activate()
+        context.block_no = block_no
+        # changes made by the method are reverted so the cached contract keeps the persisted state
+        journal = context.journal = Journal()
+        context.current_contract_hash = contract._contract_hash
+        context.contract_instances = [contract._contract_hash]
+        try:
+            return await dvm.run_method(WORKER_TIMEOUT, contract._methods[method], **kwargs)
+        finally:
+            journal.revert({})
+            contract._dirty.clear()
+
+
 @app.on_event("startup")
 async def startup():
-    global dvm
+    global dvm, contract_cache, executor
+    if SERVER_WORKERS > 0:
+        # workers are forked before the database pool is created
+        executor = ContractExecutor(SERVER_WORKERS, WORKER_TIMEOUT)
+        await executor.start()
     denaro_database: Database = await Database.get()
     dvm = DVM(denaro_database)
+    contract_cache = ContractCache(dvm, CACHE_SIZE, executor)
+    await contract_cache.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if contract_cache is not None:
+        await contract_cache.stop()
+    if executor is not None:
+        executor.shutdown()
 
 
 @app.get("/contract/{contract_hash}/{method}")
 async def call_method(contract_hash: str, method: str, request: Request):
-    contracts = await dvm.get_contracts([contract_hash])
-    contract = contracts[contract_hash]
     kwargs = dict(request.query_params)
+    # at_block is reserved to read the state at a past block
+    block_no = None
+    if 'at_block' in kwargs:
+        block_no = await get_block_no(kwargs.pop('at_block'))
+        contract = (await dvm.get_contracts([contract_hash], block_no)).get(contract_hash)
+    else:
+        contract = await contract_cache.get(contract_hash)
+    if contract is None:
+        raise HTTPException(404, f'Contract {contract_hash} does not exist' + ('' if block_no is None else f' at block {block_no}'))
     # todo remove, just for debugging purposes
     if method in contract._variables:
-        return {'ok': False, "result": contract._variables[method]}
+        return {'ok': False, "result": await dvm.read_variable(contract, method)}
     if method == 'source':
         async with dvm.database.pool.acquire() as connection:
             res = await connection.fetchrow(
@@ -33,15 +218,51 @@ async def call_method(contract_hash: str, method: str, request: Request):
             import zlib
             from fastapi import Response
             return Response(zlib.decompress(res['bytecode']).decode(), media_type='text/plain')
+    if method not in contract._methods:
+        raise HTTPException(404, f'Contract {contract_hash} has no {method} method')
 
     try:
-        res = contract._methods[method](**kwargs)
+        res = await run_read(contract, method, kwargs, block_no)
         return {"ok": True, "result": res}
     except Exception as e:
         raise
         return {"ok": True, "result": e.__class__.__name__}
 
 
+@app.post("/contracts/call")
+async def call_methods(request: Request):
+    """Runs a list of {contract_hash, method, kwargs} reads against the same block, results are returned in order.
+
+    The block is the latest one executed by the daemon, or the at_block query parameter.
+    """
+    calls = await request.json()
+    if not isinstance(calls, list) or not all(isinstance(call, dict) and 'contract_hash' in call and 'method' in call for call in calls):
+        raise HTTPException(400, 'Expected a list of {contract_hash, method, kwargs} calls')
+    if len(calls) > MAX_BATCH_SIZE:
+        raise HTTPException(413, f'At most {MAX_BATCH_SIZE} calls can be made at once')
+    if 'at_block' in request.query_params:
+        block_no = await get_block_no(request.query_params['at_block'])
+    else:
+        async with dvm.database.pool.acquire() as connection:
+            block_no, _ = await ContractCache.get_tip(connection)
+    # every distinct contract is loaded once from its state at the snapshot block
+    contracts = await dvm.get_contracts(list({call['contract_hash'] for call in calls}), block_no)
+    results = []
+    for call in calls:
+        contract, method = contracts.get(call['contract_hash']), call['method']
+        try:
+            if contract is None:
+                raise KeyError(f'contract {call["contract_hash"]} does not exist')
+            if method in contract._variables:
+                result = await dvm.read_variable(contract, method)
+            else:
+                result = await run_read(contract, method, call.get('kwargs', {}), block_no)
+            results.append({'ok': True, 'result': result})
+        except Exception as e:
+            results.append({'ok': False, 'result': f'{e.__class__.__name__}: {str(e)}'})
+    return {'ok': True, 'block_no': block_no, 'result': results}
+
+
 @app.post("/get_payload/{contract_hash}/{method}")
 async def call_method(contract_hash: str, method: str, request: Request):
     args = await request.json()
@@ -52,4 +273,33 @@ async def call_method(contract_hash: str, method: str, request: Request):
 async def call_method(tx_hash):
     async with dvm.database.pool.acquire() as connection:
         row = await connection.fetchrow("SELECT * FROM dvm_transactions WHERE tx_hash = $1", tx_hash)
-    return {'ok': True, 'result': dict(row) | {'call': ContractCall.from_payload(row['payload'])}}
+    return {'ok': True, 'result': dict(row) | {'call': ContractCall.from_payload(row['payload']).to_dict()}}
+
+
+@app.get("/get_transactions/{contract_hash}")
+async def get_transactions(contract_hash: str, limit: int = Query(MAX_PAGE_SIZE, ge=0), offset: int = Query(0, ge=0)):
+    async with dvm.database.pool.acquire() as connection:
+        rows = await connection.fetch(
+            'SELECT * FROM dvm_transactions WHERE contract_hash = $1 '
+            'ORDER BY block_no DESC, tx_hash, output_index LIMIT $2 OFFSET $3',
+            contract_hash, min(limit, MAX_PAGE_SIZE), offset
+        )
+    return {'ok': True, 'result': [dict(row) | {'call': ContractCall.from_payload(row['payload']).to_dict()} for row in rows]}
+
+
+@app.get("/get_events/{contract_hash}")
+async def get_events(contract_hash: str, name: str = None, limit: int = Query(MAX_PAGE_SIZE, ge=0), offset: int = Query(0, ge=0)):
+    args = [contract_hash, min(limit, MAX_PAGE_SIZE), offset]
+    if name is not None:
+        args.append(name)
+    async with dvm.database.pool.acquire() as connection:
+        rows = await connection.fetch(
+            'SELECT e.tx_hash, e.output_index, e.name, e.args, t.block_no FROM dvm_events e '
+            'JOIN dvm_transactions t ON t.tx_hash = e.tx_hash AND t.output_index = e.output_index '
+            f'WHERE e.contract_hash = $1{"" if name is None else " AND e.name = $4"} '
+            'ORDER BY t.block_no DESC, e.tx_hash, e.output_index LIMIT $2 OFFSET $3',
+            *args
+        )
+    return {'ok': True, 'result': [
+        dict(row) | {'args': {k: deserialize(bytes.fromhex(v)) for k, v in json.loads(row['args']).items()}} for row in rows
+    ]}
@@ -0,0 +1,177 @@
+from collections.abc import MutableMapping
+from copy import deepcopy
+from decimal import Decimal
+from typing import Dict, List, Tuple
+
+from dvm.serializer import serialized_size, deserialize
+from dvm.timeout import untimed
+
+MISSING = object()
+UNDECODED = object()
+# values of these types cannot be mutated in place, so reading them never makes a variable dirty
+IMMUTABLE_TYPES = (int, str, bool, bytes, Decimal)
+_FLAT_TYPES = IMMUTABLE_TYPES + (type(None),)
+
+
+def _value_size(value) -> int:
+    # storage maps know their encoded size without holding all their entries
+    return value.encoded_size() if hasattr(value, 'encoded_size') else serialized_size(value)
+
+
+def _snapshot(value):
+    # containers of immutable values are copied shallowly, which is much cheaper than a deepcopy
+    value_type = type(value)
+    if value_type in _FLAT_TYPES:
+        return value
+    if value_type is dict:
+        if all(type(item) in _FLAT_TYPES for item in value.values()):
+            return value.copy()
+    elif value_type is list:
+        if all(type(item) in _FLAT_TYPES for item in value):
+            return value.copy()
+    elif value_type is tuple:
+        if all(type(item) in _FLAT_TYPES for item in value):
+            return value
+    return deepcopy(value)
+
+
+def unshared(value):
+    """Copy of a container assigned to a variable or a storage map entry.
+
+    The journal records variables by name, so two variables holding the same list or dict would let a call mutate one
+    through the other without recording it, the persisted state never shares objects between variables either.
+    """
+    if type(value) in (dict, list, tuple):
+        return _snapshot(value)
+    return value
+
+
+def _size_delta(size: int, length_before: int, length_after: int) -> int:
+    return size + serialized_size(length_after) - serialized_size(length_before)
+
+
+class LazyState(MutableMapping):
+    """Contract variables that are deserialized from their encoded state only when first accessed."""
+
+    def __init__(self, encoded_state: Dict[str, str | dict], storage_maps: dict = None):
+        self._encoded_state = encoded_state
+        self._values = dict.fromkeys(encoded_state, UNDECODED)
+        # variables stored per key are not encoded in the state, their maps are built beforehand
+        self.storage_maps = storage_maps or {}
+        self._values.update(self.storage_maps)
+
+    def __getitem__(self, key):
+        value = self._values[key]
+        if value is UNDECODED:
+            # decoding depends on the size of the state, not on the call, so it is not counted in its deadline
+            with untimed():
+                value = self._values[key] = deserialize(bytes.fromhex(self._encoded_state[key]))
+        return value
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        del self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return repr({k: '<encoded>' if v is UNDECODED else v for k, v in self._values.items()})
+
+
+class Journal:
+    """Undo log of the contract variables touched by a call, replacing a full copy of the loaded states.
+
+    A variable is copied whole the first time it is touched, so touching a large dict or list costs O(size) once
+    per call (see benchmarks/journal.py), storage maps record their entries one by one instead.
+    """
+
+    def __init__(self):
+        self.entries: List[Tuple[dict, str, object, int | None]] = []
+        self.recorded: set = set()
+        self.created: List[str] = []
+        self.storage_maps: Dict[int, object] = {}
+
+    def record(self, variables: dict, key: str, size: int = None):
+        # a value is copied only the first time it is touched during the call, size is its encoded size if known
+        if (id(variables), key) in self.recorded:
+            return
+        self.recorded.add((id(variables), key))
+        if key not in variables:
+            value = MISSING
+        elif type(variables[key]) in _FLAT_TYPES:
+            value = variables[key]
+        else:
+            # the copy costs O(size) whatever the call does, so it is not counted in its deadline
+            with untimed():
+                value = _snapshot(variables[key])
+        self.entries.append((variables, key, value, size))
+
+    def record_entry(self, storage_map, key, size: int = None):
+        # storage maps keep their loaded entries as (position, value) tuples
+        self.storage_maps[id(storage_map._entries)] = storage_map
+        self.record(storage_map._entries, key, size)
+
+    def state_size_delta(self, contracts: Dict[str, object]) -> int:
+        """Size difference of the serialized {address: variables} mapping of all the contracts, before and after the call."""
+        created = [contracts[contract_hash] for contract_hash in self.created if contract_hash in contracts]
+        created_variables = {id(contract._variables) for contract in created}
+        delta = serialized_size(len(contracts)) - serialized_size(len(contracts) - len(created))
+        for contract in created:
+            delta += serialized_size(contract._contract_hash) + serialized_size(contract._variables)
+        deltas = {}
+        replaced = []
+        for variables, key, value, size in self.entries:
+            if id(variables) in created_variables:
+                continue
+            storage_map = self.storage_maps.get(id(variables))
+            if id(variables) not in deltas:
+                length = len(variables) if storage_map is None else len(storage_map)
+                deltas[id(variables)] = [0, length, length]
+            item = deltas[id(variables)]
+            # storage maps journal their entries by encoded key
+            key_size = serialized_size(key) if storage_map is None else len(key)
+            if key in variables:
+                current = variables[key] if storage_map is None else variables[key][1]
+                item[0] += key_size + _value_size(current)
+                item[1] -= 1
+            if value is not MISSING:
+                previous = value if storage_map is None else value[1]
+                item[1] += 1
+                if hasattr(previous, 'encoded_size'):
+                    # a replaced storage map is journaled by reference, its previous size is computed below
+                    replaced.append((item, key, previous))
+                else:
+                    item[0] -= key_size + (size if size is not None else _value_size(previous))
+        for item, key, storage_map in replaced:
+            # the changes of the entries of the map are part of its previous size, not of the state change
+            map_item = deltas.pop(id(storage_map._entries), None)
+            map_delta = _size_delta(*map_item) if map_item is not None else 0
+            item[0] -= serialized_size(key) + storage_map.encoded_size() - map_delta
+        for item in deltas.values():
+            delta += _size_delta(*item)
+        return abs(delta)
+
+    def revert(self, contracts: Dict[str, object]):
+        for variables, key, value, _ in reversed(self.entries):
+            if value is MISSING:
+                variables.pop(key, None)
+            else:
+                variables[key] = value
+        for contract_hash in self.created:
+            contracts.pop(contract_hash, None)
+        self.commit()
+
+    def commit(self):
+        self.entries = []
+        self.recorded = set()
+        self.created = []
+        self.storage_maps = {}
@@ -0,0 +1,101 @@
+"""Blocks written and read back by DVM, run when DVM_TEST_DATABASE is the DSN of a PostgreSQL database the tests can write to.
+
+The tables are created in a schema of their own, which is dropped afterwards.
+"""
+import asyncio
+import os
+import re
+
+import pytest
+
+from dvm import vm
+from dvm.contract import Address, ContractCreation, CURRENT_VERSION, ExecutionContext
+from dvm.state import Journal
+from dvm.vm import DVM
+
+asyncpg = pytest.importorskip('asyncpg')
+DSN = os.environ.get('DVM_TEST_DATABASE')
+pytestmark = pytest.mark.skipif(DSN is None, reason='DVM_TEST_DATABASE is not set')
+
+SCHEMA = 'dvm_test'
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'schema.sql')
+# the tables of denaro that DVM reads
+DENARO_TABLES = '''
+CREATE TABLE blocks (id INT PRIMARY KEY, hash CHAR(64) UNIQUE NOT NULL);
+CREATE TABLE transactions (tx_hash CHAR(64) PRIMARY KEY, block_hash CHAR(64) NOT NULL, tx_hex TEXT NOT NULL DEFAULT '');
+'''
+
+SOURCE_CODE = '''
+@Contract.deploy
+class Token(Contract):
+    def constructor(self, sender: str):
+        self.balances = {}
+        self.supply = 0
+
+    def mint(self, sender: str, amount: int):
+        self.balances[sender] = self.balances.get(sender, 0) + amount
+        self.supply = self.supply + amount
+'''
+CONTRACT_HASH = 'c' * 64
+
+
+class _Database:
+    def __init__(self, pool):
+        self.pool = pool
+
+
+def _block_hash(block_no: int) -> str:
+    return f'{block_no:064x}'
+
+
+async def _setup(connection):
+    await connection.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}; SET search_path TO {SCHEMA}')
+    await connection.execute(DENARO_TABLES)
+    with open(SCHEMA_PATH) as f:
+        # the statements dropping the previous tables are left out
+        await connection.execute(re.sub(r'(?im)^drop table .*$', '', f.read()))
+    for block_no in range(1, 4):
+        await connection.execute('INSERT INTO blocks VALUES ($1, $2)', block_no, _block_hash(block_no))
+        await connection.execute('INSERT INTO transactions VALUES ($1, $2)', _block_hash(block_no), _block_hash(block_no))
+
+
+async def _execute_block(dvm: DVM, block_no: int, method: str = None, created: bool = False):
+    # as the daemon does, the contracts are loaded again for every block
+    context = ExecutionContext({} if created else await dvm.get_contracts([CONTRACT_HASH])).activate()
+    context.journal = Journal()
+    tx_hash = _block_hash(block_no)
+    if created:
+        creation = ContractCreation(CURRENT_VERSION, SOURCE_CODE, ())
+        assert await dvm.create_contract(creation, CONTRACT_HASH, tx_hash, block_no, 'sender', ())
+    else:
+        contract = context.contracts[CONTRACT_HASH]
+        context.current_contract_hash, context.contract_instances = CONTRACT_HASH, [CONTRACT_HASH]
+        await dvm.run_method(None, contract._methods[method], Address('sender'), 5)
+    await dvm.commit_block(block_no, context.contracts, [], [], [(block_no, tx_hash)])
+
+
+async def _run(storage_mode: str):
+    pool = await asyncpg.create_pool(DSN, min_size=1, max_size=2, server_settings={'search_path': SCHEMA})
+    try:
+        async with pool.acquire() as connection:
+            await _setup(connection)
+        vm.STORAGE_MODE = storage_mode
+        dvm = DVM(_Database(pool))
+        await _execute_block(dvm, 1, created=True)
+        # blocks writing diff rows, or only storage rows, keep pointing to the checkpoint of the creation
+        await _execute_block(dvm, 2, 'mint')
+        await _execute_block(dvm, 3, 'mint')
+        async with pool.acquire() as connection:
+            pointer = await connection.fetchrow('SELECT block_no, checkpoint_block_no FROM dvm_latest_state WHERE contract_hash = $1', CONTRACT_HASH)
+        contract = (await dvm.get_contracts([CONTRACT_HASH]))[CONTRACT_HASH]
+        return tuple(pointer), contract._variables['supply'], await dvm.read_variable(contract, 'balances')
+    finally:
+        vm.STORAGE_MODE = 'blob'
+        async with pool.acquire() as connection:
+            await connection.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+        await pool.close()
+
+
+@pytest.mark.parametrize('storage_mode', ['blob', 'keyed'])
+def test_diff_blocks(storage_mode):
+    assert asyncio.run(_run(storage_mode)) == ((3, 1), 10, {'sender': 10})
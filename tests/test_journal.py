@@ -0,0 +1,40 @@
+"""Undo log of the variables touched by a call, and the state size difference it computes for the gas."""
+import pytest
+
+from dvm.contract import ExecutionContext
+from dvm.serializer import serialize, serialized_size
+from dvm.state import Journal
+from dvm.vm import instantiate_contract
+
+CONTRACT_HASH = '0' * 64
+SOURCE_CODE = '''
+@Contract.deploy
+class Aliases(Contract):
+    def alias(self):
+        self.y = self.x
+
+    def append(self):
+        self.x.append(len(self.x))
+'''
+
+
+@pytest.fixture
+def context():
+    context = ExecutionContext().activate()
+    context.journal = Journal()
+    return context
+
+
+def test_assigned_containers_are_not_shared(context):
+    encoded_state = {'x': serialize([0]).hex(), 'y': serialize([]).hex()}
+    contract = instantiate_contract(CONTRACT_HASH, SOURCE_CODE, encoded_state)
+    context.contracts = {CONTRACT_HASH: contract}
+    context.current_contract_hash = CONTRACT_HASH
+    contract._methods['alias']()
+    context.journal.commit()
+    # a later call mutating x only changes x, and reverting it restores x without leaving y changed
+    contract._methods['append']()
+    assert context.journal.state_size_delta(context.contracts) == serialized_size([0, 1]) - serialized_size([0])
+    assert contract._variables['y'] == [0]
+    context.journal.revert(context.contracts)
+    assert contract._variables['x'] == [0] and contract._variables['y'] == [0]
@@ -0,0 +1,137 @@
+"""Payloads of transactions decide which calls are valid, both parsers must agree with the original one."""
+import random
+import zlib
+from io import BytesIO
+
+import pytest
+
+from dvm.contract import CURRENT_VERSION, MAX_PAYLOAD_SIZE, ContractCall, ContractCallList, ContractCreation
+from dvm.serializer import serialize, deserialize
+
+ENDIAN = 'little'
+
+
+# the parser before the strict rules, as it was written
+
+def original_call_from_payload(payload: bytes | str):
+    if isinstance(payload, str):
+        payload = bytes.fromhex(payload)
+    try:
+        payload = zlib.decompress(payload)
+    except zlib.error:
+        pass
+    buffer = BytesIO(payload)
+    specifier = buffer.read(5)
+    kind = int.from_bytes(buffer.read(1), ENDIAN)
+    if kind == 0:
+        source_code_length = int.from_bytes(buffer.read(2), ENDIAN)
+        source_code = buffer.read(source_code_length).decode()
+        args_length = int.from_bytes(buffer.read(2), ENDIAN)
+        args = deserialize(buffer.read(args_length))
+        return 'creation', specifier, source_code, args
+    contract_hash = buffer.read(32).hex()
+    method_length = int.from_bytes(buffer.read(1), ENDIAN)
+    method = buffer.read(method_length).decode()
+    args = deserialize(buffer.read())
+    return 'call', specifier, contract_hash, method, args
+
+
+def original_from_payload(payload: bytes | str):
+    if isinstance(payload, str):
+        payload = bytes.fromhex(payload)
+    try:
+        payload = zlib.decompress(payload)
+    except zlib.error:
+        pass
+    try:
+        return [original_call_from_payload(contract_call) for contract_call in deserialize(payload)]
+    except TypeError as e:
+        if str(e) != 'Invalid serialized type':
+            raise
+        return [original_call_from_payload(payload)]
+
+
+def _normalize(contract_call):
+    if isinstance(contract_call, ContractCreation):
+        return 'creation', contract_call.specifier, contract_call.source_code, contract_call.args
+    return 'call', contract_call.specifier, contract_call.contract_hash, contract_call.method, contract_call.args
+
+
+def _id(payload) -> str:
+    return (payload if isinstance(payload, str) else payload.hex())[:16]
+
+
+def _outcome(func, payload):
+    try:
+        result = func(payload)
+    except Exception:
+        return None
+    calls = result.contract_calls if isinstance(result, ContractCallList) else result
+    return repr([call if isinstance(call, tuple) else _normalize(call) for call in calls])
+
+
+CALL = ContractCall(CURRENT_VERSION, 'ab' * 32, 'transfer', ('x', 5, b'\x01', [1, 2])).get_payload()
+CREATION = ContractCreation(CURRENT_VERSION, 'value = 1\n' * 20, (1, 'a')).get_payload()
+
+WELL_FORMED = [
+    CALL, zlib.compress(CALL), CREATION, zlib.compress(zlib.compress(CALL)), CALL.hex(),
+    ContractCallList([ContractCall(CURRENT_VERSION, 'cd' * 32, 'method', ()), ContractCreation(CURRENT_VERSION, 'x', ())] * 3).get_payload(),
+    serialize([CALL, CREATION]), serialize((CALL, zlib.compress(CALL))), serialize([]),
+    ContractCall(CURRENT_VERSION, 'ef' * 32, 'é' * 10, ({'a': [True]},)).get_payload(),
+    # reads past the end are truncated
+    serialize([CALL])[:-4],
+]
+
+# accepted by the original parser only
+LEGACY = [
+    serialize([CALL.hex(), CREATION.hex()]),
+    serialize({CALL: 1, CREATION: 2}),
+    serialize(' '),
+    zlib.compress(b'\x00' * (MAX_PAYLOAD_SIZE + 1)),
+    zlib.compress(serialize([CALL] * (MAX_PAYLOAD_SIZE // len(CALL) + 1))),
+]
+
+INVALID = [b'', b'\x07', serialize(5), serialize([5]), serialize('ab'), 'zz', b'\xff' * 50]
+
+
+def _corrupted(count: int):
+    rng = random.Random(0)
+    payloads = []
+    for _ in range(count):
+        payload = bytearray(rng.choice([p for p in WELL_FORMED + LEGACY if isinstance(p, bytes) and len(p) < 10000]))
+        operation = rng.random()
+        if operation < 0.3:
+            payload = payload[:rng.randrange(len(payload))]
+        elif operation < 0.7:
+            for _ in range(rng.randrange(1, 4)):
+                payload[rng.randrange(len(payload))] = rng.randrange(256)
+        else:
+            payload += bytes(rng.randrange(256) for _ in range(rng.randrange(1, 8)))
+        payloads.append(bytes(payload))
+    return payloads
+
+
+@pytest.mark.parametrize('payload', WELL_FORMED + LEGACY + INVALID + _corrupted(1000), ids=_id)
+def test_legacy_rules_match_the_original_parser(payload):
+    assert _outcome(ContractCallList.from_payload, payload) == _outcome(original_from_payload, payload)
+
+
+@pytest.mark.parametrize('payload', WELL_FORMED, ids=_id)
+def test_strict_rules_match_the_original_parser_on_well_formed_payloads(payload):
+    expected = _outcome(original_from_payload, payload)
+    assert expected is not None
+    assert _outcome(lambda p: ContractCallList.from_payload(p, strict=True), payload) == expected
+
+
+@pytest.mark.parametrize('payload', LEGACY + INVALID, ids=_id)
+def test_strict_rules_reject(payload):
+    with pytest.raises(Exception):
+        ContractCallList.from_payload(payload, strict=True)
+
+
+@pytest.mark.parametrize('payload', _corrupted(1000), ids=_id)
+def test_strict_rules_accept_a_subset(payload):
+    # a payload accepted by the strict rules is parsed the same by the original parser
+    strict = _outcome(lambda p: ContractCallList.from_payload(p, strict=True), payload)
+    if strict is not None:
+        assert strict == _outcome(original_from_payload, payload)
@@ -0,0 +1,95 @@
+"""The fast engine must encode and decode exactly like the reference one, including on invalid input."""
+import random
+from decimal import Decimal
+
+import pytest
+
+from dvm.serializer import Type, fast_deserialize, fast_serialize, reference_deserialize, reference_serialize
+
+VALUES = [
+    0, 1, -1, 127, 128, -129, 255, 256, 4095, 4096, 2 ** 63, -2 ** 100, 2 ** 1000,
+    '', 'a', 'dvm', 'é', '€' * 100, 'a' * 5000,
+    True, False,
+    b'', b'\x00', bytes(range(256)), b'x' * 5000,
+    Decimal('0'), Decimal('1.5'), Decimal('-0.001'), Decimal('1E+5'), Decimal('10.000'),
+    {}, {'a': 1}, {1: 'a', b'k': Decimal('2.5'), Decimal('1.5'): 0}, {True: b'', 'k': False},
+    [], [1, 'a', True, b'b', Decimal('3')], list(range(5000)),
+    (), (1,), ('a', (b'b', [Decimal('1.1')])),
+    {'balances': {'a': 10, 'b': [1, (2, {'c': b'd'})]}, 'owner': 'x' * 64, 'paused': False},
+    [[[[[[]]]]], {(): {(1, 'a'): [True]}}],
+]
+
+
+def _id(value) -> str:
+    return type(value).__name__
+
+
+def _outcome(func, data):
+    try:
+        return 'ok', repr(func(data))
+    except Exception as e:
+        return 'error', type(e)
+
+
+def _assert_same_decoding(data: bytes):
+    assert _outcome(fast_deserialize, data) == _outcome(reference_deserialize, data), data.hex()
+
+
+def test_every_type_is_covered():
+    assert {type(value).__name__ for value in VALUES} == {t.name for t in Type}
+
+
+@pytest.mark.parametrize('value', VALUES, ids=_id)
+def test_encoding(value):
+    encoded = reference_serialize(value)
+    assert fast_serialize(value) == encoded
+    assert repr(fast_deserialize(encoded)) == repr(reference_deserialize(encoded))
+    assert fast_deserialize(encoded) == value
+
+
+@pytest.mark.parametrize('value', [None, 1.5, {1, 2}, [object()], Decimal('1.' + '1' * 40), 2 ** (8 * 0x8000)], ids=_id)
+def test_encoding_errors(value):
+    with pytest.raises(Exception) as reference_error:
+        reference_serialize(value)
+    with pytest.raises(reference_error.type):
+        fast_serialize(value)
+
+
+@pytest.mark.parametrize('value', VALUES, ids=_id)
+def test_truncated(value):
+    encoded = reference_serialize(value)
+    for length in range(min(len(encoded), 300)):
+        _assert_same_decoding(encoded[:length])
+
+
+@pytest.mark.parametrize('value', VALUES, ids=_id)
+def test_corrupted(value):
+    rng = random.Random(repr(value))
+    encoded = reference_serialize(value)
+    for _ in range(200):
+        corrupted = bytearray(encoded)
+        for _ in range(rng.randrange(1, 4)):
+            corrupted[rng.randrange(len(corrupted))] = rng.randrange(256)
+        _assert_same_decoding(bytes(corrupted))
+
+
+@pytest.mark.parametrize('data', [
+    b'', b'\x00', b'\xff', bytes([len(Type) + 1]),
+    # negative and huge lengths
+    bytes([Type.str.value, Type.int.value, 2, 0]) + (-1).to_bytes(2, 'little', signed=True) + b'abc',
+    bytes([Type.list.value, Type.int.value, 8, 0]) + (2 ** 62).to_bytes(8, 'little'),
+    bytes([Type.bytes.value, Type.int.value, 0xff, 0xff]),
+    # unhashable dict key
+    bytes([Type.dict.value]) + reference_serialize(1) + reference_serialize([]) + reference_serialize(1),
+    # invalid utf-8 and decimal
+    bytes([Type.str.value]) + reference_serialize(1) + b'\xff',
+    bytes([Type.Decimal.value]) + reference_serialize(3) + b'1.x',
+])
+def test_invalid(data):
+    _assert_same_decoding(data)
+
+
+def test_random_bytes():
+    rng = random.Random(0)
+    for _ in range(5000):
+        _assert_same_decoding(bytes(rng.randrange(256) for _ in range(rng.randrange(16))))
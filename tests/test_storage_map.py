@@ -0,0 +1,105 @@
+"""Keyed storage of top-level dict variables, entries are identified by their encoded key."""
+from decimal import Decimal
+
+import pytest
+
+from dvm.contract import ExecutionContext, StorageMap, StorageMiss
+from dvm.serializer import serialize, serialized_size
+from dvm.state import Journal
+
+CONTRACT_HASH = '0' * 64
+
+
+def _storage_map(length: int = 0) -> StorageMap:
+    return StorageMap(CONTRACT_HASH, 'balances', {'since': 1, 'length': length, 'size': 0, 'next': length})
+
+
+def _row(key, position, value):
+    return serialize(key).hex(), position, None if value is None else serialize(value).hex()
+
+
+@pytest.fixture(autouse=True)
+def context():
+    context = ExecutionContext().activate()
+    context.journal = Journal()
+    return context
+
+
+def test_mixed_bool_and_int_keys():
+    storage_map = _storage_map()
+    storage_map[1] = 'one'
+    storage_map[True] = 'true'
+    storage_map[0] = 'zero'
+    storage_map[False] = 'false'
+    assert len(storage_map) == 4
+    assert storage_map[1] == 'one' and storage_map[True] == 'true'
+    assert storage_map[0] == 'zero' and storage_map[False] == 'false'
+    assert [(type(key), key) for key in storage_map] == [(int, 1), (bool, True), (int, 0), (bool, False)]
+    del storage_map[True]
+    assert 1 in storage_map and True not in storage_map
+    assert len(storage_map) == 3
+
+
+def test_keys_encoded_the_same_are_the_same_entry():
+    storage_map = _storage_map()
+    storage_map[Decimal('1.0')] = 'a'
+    assert storage_map[Decimal('1')] == 'a'
+    assert len(storage_map) == 1
+
+
+def test_load_keeps_keys_with_the_same_value():
+    storage_map = _storage_map(2)
+    with pytest.raises(StorageMiss):
+        storage_map[True]
+    keys = [serialize(1), serialize(True), serialize(2)]
+    storage_map.load([_row(True, 1, 'true'), _row(1, 0, 'one')], keys)
+    assert storage_map[1] == 'one'
+    assert storage_map[True] == 'true'
+    assert 2 not in storage_map
+    with pytest.raises(StorageMiss):
+        storage_map[3]
+
+
+def test_deleted_rows_are_missing():
+    storage_map = _storage_map(1)
+    storage_map.load([_row(True, None, None), _row(1, 0, 'one')])
+    assert list(storage_map) == [1]
+    assert True not in storage_map
+
+
+def test_unhashable_keys_are_rejected():
+    storage_map = _storage_map()
+    with pytest.raises(TypeError):
+        storage_map[[1]] = 'a'
+
+
+def test_revert(context):
+    storage_map = _storage_map(2)
+    storage_map.load([_row(1, 0, 'one'), _row(True, 1, 'true')])
+    context.journal.commit()
+    storage_map[True] = 'changed'
+    del storage_map[1]
+    storage_map[False] = 'new'
+    context.journal.revert({})
+    assert [(type(key), value) for key, value in storage_map.items()] == [(int, 'one'), (bool, 'true')]
+
+
+def test_persist_and_sizes():
+    storage_map = _storage_map()
+    storage_map[1] = 'one'
+    storage_map[True] = 'true'
+    rows = []
+    meta = storage_map.persist(2, rows)
+    assert sorted(row[2] for row in rows) == sorted([serialize(1).hex(), serialize(True).hex()])
+    assert meta['length'] == 2
+    assert meta['size'] == sum(serialized_size(key) + serialized_size(value) for key, value in ((1, 'one'), (True, 'true')))
+    assert storage_map.encoded_size() == 1 + serialized_size(2) + meta['size']
+
+
+def test_state_size_delta(context):
+    storage_map = _storage_map(1)
+    storage_map.load([_row(1, 0, 'one')])
+    context.journal.commit()
+    storage_map[True] = 'true'
+    storage_map[1] = 'uno'
+    assert context.journal.state_size_delta({}) == serialized_size(True) + serialized_size('true')
@@ -21,31 +21,164 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import ctypes
+import heapq
+import itertools
 import threading
+from contextlib import contextmanager
 from inspect import iscoroutinefunction
-
-try:
-    import thread
-except ImportError:
-    import _thread as thread
+from time import monotonic, sleep
 
 
 class ContractTimeoutException(Exception):
     ...
 
 
-def timeout_handler() -> None:
-    raise ContractTimeoutException()
+class _Suspend:
+    """Yields a value of the coroutine being stepped to the event loop and returns what the loop sends back."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __await__(self):
+        return (yield self.value)
+
+
+class _Guard:
+    """Deadline of a call, the exception is only raised asynchronously while the call is running contract code."""
+
+    def __init__(self, seconds: float):
+        self.deadline = monotonic() + seconds
+        self.thread_id = threading.get_ident()
+        self.active = False
+        # set by the watchdog while it checks active and raises the exception
+        self.firing = False
+        self.fired = False
+        self.done = False
+
+    def run(self, func, *args, **kwargs):
+        self._enter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._exit()
+
+    def _enter(self):
+        with _condition:
+            if monotonic() >= self.deadline:
+                raise ContractTimeoutException()
+            _running.guard = self
+            self.active = True
+
+    def _exit(self):
+        # the exception can be raised anywhere in here until it is cleared, so no lock is taken:
+        # the watchdog sets firing before reading active, once active is unset and firing is seen unset,
+        # it either has already raised the exception or will not raise it anymore
+        self.active = False
+        _running.guard = None
+        while self.firing:
+            sleep(0)
+        if self.fired:
+            # the exception may still be pending if it has been set while the call was returning
+            _set_async_exc(self.thread_id, None)
+            # contract code can catch the exception, the call fails anyway
+            raise ContractTimeoutException()
+
+    def _resume(self, paused: float):
+        # the deadline is postponed by the time the guard has been paused, the previous entry of the heap is skipped
+        with _condition:
+            self.deadline += paused
+            heapq.heappush(_deadlines, (self.deadline, next(_counter), self))
+            if _deadlines[0][2] is self:
+                _condition.notify()
+        self._enter()
+
+
+@contextmanager
+def untimed():
+    """Time spent in the block is not counted in the deadline of the running call, e.g. decoding the state it reads."""
+    guard = getattr(_running, 'guard', None)
+    if guard is None or not guard.active or guard.fired or guard.done:
+        yield
+        return
+    guard._exit()
+    start = monotonic()
+    try:
+        yield
+    finally:
+        guard._resume(monotonic() - start)
+
+
+def _set_async_exc(thread_id: int, exception) -> None:
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread_id), ctypes.py_object(exception) if exception else None)
+
+
+# (deadline, counter, guard) of the running calls, served by a single watchdog thread
+_deadlines: list = []
+_counter = itertools.count()
+_condition = threading.Condition()
+# guard active in the thread, if any
+_running = threading.local()
+_watchdog: threading.Thread | None = None
+
+
+def _watch() -> None:
+    with _condition:
+        while True:
+            # guards that have been paused have been pushed again with a later deadline
+            while _deadlines and (_deadlines[0][2].done or _deadlines[0][0] != _deadlines[0][2].deadline):
+                heapq.heappop(_deadlines)
+            if not _deadlines:
+                _condition.wait()
+                continue
+            deadline, _, guard = _deadlines[0]
+            now = monotonic()
+            if now < deadline:
+                _condition.wait(deadline - now)
+                continue
+            heapq.heappop(_deadlines)
+            # a call waiting on the event loop is stopped when it runs again
+            guard.firing = True
+            if guard.active and not guard.fired:
+                guard.fired = True
+                _set_async_exc(guard.thread_id, ContractTimeoutException)
+            guard.firing = False
+
+
+def _schedule(guard: _Guard) -> None:
+    global _watchdog
+    with _condition:
+        if _watchdog is None:
+            _watchdog = threading.Thread(target=_watch, name='contract-timeout', daemon=True)
+            _watchdog.start()
+        heapq.heappush(_deadlines, (guard.deadline, next(_counter), guard))
+        if _deadlines[0][2] is guard:
+            _condition.notify()
 
 
 async def timeout(s, func, *args, **kwargs):
-    timer = threading.Timer(s, thread.interrupt_main)
-    timer.start()
+    guard = _Guard(s)
+    _schedule(guard)
     try:
-        if iscoroutinefunction(func):
-            result = await func(*args, **kwargs)
-        else:
-            result = func(*args, **kwargs)
+        if not iscoroutinefunction(func):
+            return guard.run(func, *args, **kwargs)
+        # the coroutine is stepped manually, so that the guard is active only while it runs
+        coroutine = func(*args, **kwargs)
+        try:
+            value, error = None, None
+            while True:
+                try:
+                    if error is None:
+                        suspended = guard.run(coroutine.send, value)
+                    else:
+                        suspended = guard.run(coroutine.throw, error)
+                except StopIteration as e:
+                    return e.value
+                try:
+                    value, error = await _Suspend(suspended), None
+                except BaseException as e:
+                    value, error = None, e
+        finally:
+            coroutine.close()
     finally:
-        timer.cancel()
-    return result
+        guard.done = True
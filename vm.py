@@ -1,23 +1,48 @@
+import ast
+import hashlib
+import inspect
 import json
+import linecache
+import marshal
+import os
+import sys
 import zlib
-from copy import deepcopy
+from collections import OrderedDict
 from decimal import Decimal
+from types import CodeType
+from typing import Dict
 
 from RestrictedPython import compile_restricted, safe_builtins, RestrictingNodeTransformer
 from RestrictedPython.Eval import default_guarded_getiter, default_guarded_getitem
 from RestrictedPython.Guards import guarded_iter_unpack_sequence, guarded_unpack_sequence, full_write_guard
 from denaro import Database
 
-from dvm.contract import ContractCreation, Contract, LimitedContract, Address, Event, ContractsCache, \
-    CONTRACT_METHOD_TIMEOUT
-from dvm.serializer import deserialize
+from dvm.contract import ContractCreation, Contract, LimitedContract, Address, Event, ExecutionContext, \
+    CONTRACT_METHOD_TIMEOUT, StorageMap, OutOfGas
+from dvm.serializer import deserialize, serialize, serialized_size
+from dvm.state import Journal, LazyState
 from dvm.timeout import timeout
 
+# bump it every time DVMNodeTransformer or contract compilation changes, so cached bytecode gets invalidated
+POLICY_VERSION = 1
+# a full state is written after this number of diffs, so that reading a state needs a bounded number of rows
+STATE_CHECKPOINT_INTERVAL = 64
+# 'keyed' stores top-level dict variables per key in dvm_storage instead of inside the state blob
+STORAGE_MODE = os.environ.get('DVM_STORAGE_MODE', 'blob')
+# after this number of storage misses in a call, whole maps are loaded instead of single entries
+MAX_STORAGE_MISSES = 16
+# number of states at past blocks kept reconstructed
+HISTORICAL_STATES_CACHE_SIZE = 128
+# block from which the statements run by contracts are charged gas, it changes the gas of calls, so every node has to
+# use the same one, unset until it is scheduled
+GAS_METERING_BLOCK: int | None = None
+CODE_CACHE_DIR = os.environ.get('DVM_CODE_CACHE', os.path.join(os.path.dirname(__file__), '__pycache__', 'contracts'))
+
 
 def _write_(obj):
     if isinstance(obj, Contract) and obj.__class__ != LimitedContract:
         return obj
-    if type(obj) in (dict, list):
+    if type(obj) in (dict, list, StorageMap):
         return obj
     raise Exception(f'Cannot write to {obj.__class__.__name__}')
 
@@ -31,6 +56,31 @@ def _inplacevar_(op: str, value, arg):
         raise NotImplementedError(f'Operator {op} not implemented')
 
 
+def _gas_(steps: int = 1):
+    context = ExecutionContext.current()
+    if not context.metered:
+        return
+    context.additional_gas += steps
+    if context.additional_gas > context.gas_limit:
+        raise OutOfGas(context.gas_limit)
+
+
+def _gas_iter_(iterable):
+    if not ExecutionContext.current().metered:
+        return iterable
+    # comprehensions cannot break, so sized iterables are charged at once before running
+    if isinstance(iterable, (range, list, tuple, dict, set, str, bytes)):
+        _gas_(len(iterable))
+        return iterable
+    return _gas_each_(iterable)
+
+
+def _gas_each_(iterable):
+    for item in iterable:
+        _gas_()
+        yield item
+
+
 class NonOverridable(type):
     def __new__(mcs, name, bases, dct):
         if Contract in bases and any(d in dir(Contract) for d in dct if d not in ('__module__', '__qualname__')):
@@ -39,10 +89,11 @@ class NonOverridable(type):
 
 
 async def load_contract(contract_hash: str):
-    if contract_hash not in ContractsCache.contracts:
-        contract = (await DVM.instance.get_contracts([contract_hash]))[contract_hash]
-        ContractsCache.contracts[contract_hash] = contract
-        ContractsCache.contracts_backup[contract_hash] = deepcopy(contract)
+    context = ExecutionContext.current()
+    if contract_hash not in context.contracts:
+        # contracts are read at the same block as the contracts already loaded
+        contract = (await DVM.instance.get_contracts([contract_hash], context.block_no))[contract_hash]
+        context.contracts[contract_hash] = contract
     return LimitedContract(contract_hash)
 
 
@@ -54,7 +105,8 @@ contract_globals = safe_builtins | {
     '_iter_unpack_sequence_': guarded_iter_unpack_sequence,
     '_unpack_sequence_': guarded_unpack_sequence,
     '_getiter_': default_guarded_getiter,
-    '_getitem_': default_guarded_getitem
+    '_getitem_': default_guarded_getitem,
+    '_gas_': _gas_, '_gas_iter_': _gas_iter_
 }
 
 
@@ -68,117 +120,488 @@ class DVMNodeTransformer(RestrictingNodeTransformer):
         return self.node_contents_visit(node)
 
 
+class MeteredNodeTransformer(DVMNodeTransformer):
+    """Charges gas at function entries and loop iterations, one per statement of the body, and one per comprehension item.
+
+    Names starting with an underscore are rejected in contract code, so the injected calls cannot be shadowed.
+    """
+
+    @staticmethod
+    def meter(node):
+        call = ast.Expr(ast.Call(func=ast.Name('_gas_', ast.Load()), args=[ast.Constant(len(node.body))], keywords=[]))
+        node.body.insert(0, ast.fix_missing_locations(ast.copy_location(call, node.body[0])))
+        return node
+
+    def visit_FunctionDef(self, node):
+        return self.meter(super().visit_FunctionDef(node))
+
+    def visit_AsyncFunctionDef(self, node):
+        return self.meter(super().visit_AsyncFunctionDef(node))
+
+    def visit_For(self, node):
+        return self.meter(super().visit_For(node))
+
+    def visit_While(self, node):
+        return self.meter(super().visit_While(node))
+
+    def visit_comprehension(self, node):
+        node = super().visit_comprehension(node)
+        call = ast.Call(func=ast.Name('_gas_iter_', ast.Load()), args=[node.iter], keywords=[])
+        node.iter = ast.fix_missing_locations(ast.copy_location(call, node.iter))
+        return node
+
+
+compiled_contracts: Dict[str, CodeType] = {}
+
+
+def compile_contract(source_code: str, metering: bool = GAS_METERING_BLOCK is not None) -> CodeType:
+    # once metering is scheduled contracts are compiled with its calls, which only charge gas in blocks from GAS_METERING_BLOCK
+    source_hash = hashlib.sha256(source_code.encode()).hexdigest()
+    key = f'{source_hash}.{POLICY_VERSION}{".metered" if metering else ""}'
+    if key in compiled_contracts:
+        return compiled_contracts[key]
+    # tracebacks show this name, and the lines of the source through linecache
+    filename = f'<contract {source_hash[:12]}>'
+    linecache.cache[filename] = (len(source_code), None, source_code.splitlines(True), filename)
+    cache_path = os.path.join(CODE_CACHE_DIR, f'{key}.{sys.implementation.cache_tag}.bin')
+    try:
+        with open(cache_path, 'rb') as f:
+            bytecode = marshal.load(f)
+        if not isinstance(bytecode, CodeType) or bytecode.co_filename != filename:
+            raise ValueError(f'corrupt bytecode cache entry {cache_path}')
+    except (OSError, EOFError, ValueError, TypeError):
+        policy = MeteredNodeTransformer if metering else DVMNodeTransformer
+        bytecode = compile_restricted(source_code, filename, policy=policy)
+        try:
+            os.makedirs(CODE_CACHE_DIR, exist_ok=True)
+            with open(f'{cache_path}.{os.getpid()}', 'wb') as f:
+                marshal.dump(bytecode, f)
+            os.replace(f'{cache_path}.{os.getpid()}', cache_path)
+        except OSError as e:
+            print(f'Could not write bytecode cache for {source_hash}: {e}')
+    compiled_contracts[key] = bytecode
+    return bytecode
+
+
+def instantiate_contract(contract_hash: str, source_code: str, encoded_state: dict, block_no: int = None) -> Contract:
+    """Runs the source code of a contract and instantiates it from its encoded state, variables are decoded on access."""
+    context = ExecutionContext.current()
+    exec(compile_contract(source_code), contract_globals, {})
+    storage_maps = {k: StorageMap(contract_hash, k, v, block_no) for k, v in encoded_state.items() if type(v) is dict}
+    contract_class, context.deployed = context.deployed, None
+    contract = contract_class(contract_hash, LazyState(encoded_state, storage_maps))
+    contract._encoded_state = encoded_state
+    contract._source_code = source_code
+    return contract
+
+
 class DVM:
     instance: "DVM" = None
 
     def __init__(self, database: Database):
         self.database = database
+        # (contract_hash, block_no) -> (encoded_state, state_diffs) of states that cannot change anymore
+        self.historical_states: Dict[tuple, tuple] = OrderedDict()
         DVM.instance = self
 
     async def create_contract(self, contract_creation: ContractCreation, contract_hash: str, tx_hash: str, block_no: int, sender: str, args, kwargs={}):
+        context = ExecutionContext.current()
         try:
-            bytecode = compile_restricted(contract_creation.source_code, f'Contract <{contract_hash}>', policy=DVMNodeTransformer)
+            bytecode = compile_contract(contract_creation.source_code)
             exec(bytecode, contract_globals, {})
-            contract = Contract.deployed(contract_hash, {})
-            Contract.deployed = None
+            contract_class, context.deployed = context.deployed, None
+            contract = contract_class(contract_hash, {})
         except Exception as e:
             print(f'Contract has not been deployed because of a {e.__class__.__name__}: {str(e)} exception occurred while executing bytecode')
             raise
             return False
         if 'constructor' in contract._methods:
-            ContractsCache.current_contract_hash = contract_hash
-            ContractsCache.contract_instances = [contract_hash]
+            context.current_contract_hash = contract_hash
+            context.contract_instances = [contract_hash]
             try:
-                await timeout(CONTRACT_METHOD_TIMEOUT, contract._methods['constructor'], Address(sender), *args, **kwargs)
+                await self.run_method(CONTRACT_METHOD_TIMEOUT, contract._methods['constructor'], Address(sender), *args, **kwargs)
             except Exception as e:
                 print(f'Contract has not been deployed because of a {e.__class__.__name__}: {str(e)} exception occurred while executing constructor')
                 return False
         try:
-            contract_state = contract.get_json_state()
+            encoded_state = contract.get_encoded_state()
         except Exception as e:
             print(f'Contract has not been deployed because there has been an {e.__class__.__name__}: {str(e)} exception while encoding data in constructor')
             return False
-        async with self.database.pool.acquire() as connection:
-            await connection.execute(
-                'INSERT INTO dvm(contract_hash, creation_transaction, source_code) VALUES ($1, $2, $3)',
-                contract_hash,
-                tx_hash,
-                zlib.compress(contract_creation.source_code.encode())
-            )
-            await connection.execute(
-                'INSERT INTO dvm_state(contract_hash, block_no, state) VALUES ($1, $2, $3)',
-                contract_hash,
-                block_no,
-                contract_state
-            )
+        # the contract is written with the rest of the block by commit_block
+        contract._creation = (tx_hash, zlib.compress(contract_creation.source_code.encode()))
+        contract._encoded_state = encoded_state
+        contract._dirty.clear()
         print(f'Created contract {contract_hash}')
-        ContractsCache.contracts[contract_hash] = contract
+        context.contracts[contract_hash] = contract
+        if context.journal is not None:
+            context.journal.created.append(contract_hash)
         return contract
 
-    async def get_contracts(self, contracts_hashes: list):
+    async def get_contracts(self, contracts_hashes: list, block_no: int = None):
+        """Instantiates the contracts from their latest state, or from their state at block_no."""
         async with self.database.pool.acquire() as connection:
             res = await connection.fetch('SELECT contract_hash, source_code FROM dvm WHERE contract_hash = ANY($1)', contracts_hashes)
-        contracts_states = await self.get_contract_states(contracts_hashes)
+        encoded_states = await self.get_encoded_states(contracts_hashes, block_no)
         contracts = {}
         for res in res:
             contract_hash, source_code = res
+            if contract_hash not in encoded_states:
+                # created after block_no
+                continue
+            encoded_state, state_diffs, state_block = encoded_states[contract_hash]
             source_code = zlib.decompress(source_code).decode()
-            bytecode = compile_restricted(source_code, f'Contract <{contract_hash}>', policy=DVMNodeTransformer)
             try:
-                exec(bytecode, contract_globals, {})
-                contract = Contract.deployed(contract_hash, contracts_states[contract_hash])
-                Contract.deployed = None
+                contract = instantiate_contract(contract_hash, source_code, encoded_state, block_no)
             except Exception as e:
                 print(f'Contract {contract_hash} has not been get because a {e.__class__.__name__}: {str(e)} exception occurred while executing bytecode')
                 continue
+            contract._state_diffs, contract._state_block = state_diffs, state_block
             contracts[contract_hash] = contract
         return contracts
 
-    async def get_contract_states(self, contract_hashes: list):
+    async def get_encoded_states(self, contract_hashes: list, block_no: int = None):
+        """Returns the (encoded state, diffs since the last checkpoint, block of the last state row) of the contracts."""
+        states = {}
+        if block_no is not None:
+            for contract_hash in contract_hashes:
+                if (contract_hash, block_no) in self.historical_states:
+                    self.historical_states.move_to_end((contract_hash, block_no))
+                    states[contract_hash] = self.historical_states[(contract_hash, block_no)]
+            contract_hashes = [contract_hash for contract_hash in contract_hashes if contract_hash not in states]
+            if not contract_hashes:
+                return states
+        # rebuilds every state from its latest checkpoint and the diffs written after it
         async with self.database.pool.acquire() as connection:
-            res = await connection.fetch(
-                'SELECT DISTINCT ON (contract_hash) contract_hash, state FROM dvm_state WHERE contract_hash = ANY($1) ORDER BY contract_hash, block_no DESC',
-                contract_hashes
-            )
-        return {contract_hash: {k: deserialize(bytes.fromhex(v)) for k, v in json.loads(state).items()} for contract_hash, state in res}
+            if block_no is None:
+                res = await connection.fetch(
+                    'SELECT s.contract_hash, s.state, s.checkpoint, s.block_no FROM dvm_state s JOIN dvm_latest_state l USING (contract_hash) '
+                    'WHERE s.contract_hash = ANY($1) AND s.block_no >= l.checkpoint_block_no '
+                    'ORDER BY s.contract_hash, s.block_no, s.checkpoint DESC',
+                    contract_hashes
+                )
+            else:
+                res = await connection.fetch(
+                    'SELECT contract_hash, state, checkpoint, block_no FROM dvm_state s WHERE contract_hash = ANY($1) AND block_no <= $2 AND block_no >= '
+                    '(SELECT MAX(block_no) FROM dvm_state c WHERE c.contract_hash = s.contract_hash AND c.checkpoint AND block_no <= $2) '
+                    'ORDER BY contract_hash, block_no, checkpoint DESC',
+                    contract_hashes, block_no
+                )
+            latest_block_no = None if block_no is None else await connection.fetchval('SELECT MAX(block_no) FROM dvm_state')
+        fetched = {}
+        for contract_hash, state, checkpoint, state_block in res:
+            if checkpoint:
+                fetched[contract_hash] = (json.loads(state), 0, state_block)
+            else:
+                encoded_state, state_diffs, _ = fetched[contract_hash]
+                fetched[contract_hash] = (encoded_state | json.loads(state), state_diffs + 1, state_block)
+        # blocks are written in a single transaction, so states up to the latest written block are final
+        if latest_block_no is not None and block_no <= latest_block_no:
+            for contract_hash, state in fetched.items():
+                self.historical_states[(contract_hash, block_no)] = state
+            while len(self.historical_states) > HISTORICAL_STATES_CACHE_SIZE:
+                self.historical_states.popitem(last=False)
+        return states | fetched
+
+    async def get_contract_states(self, contract_hashes: list, block_no: int = None):
+        encoded_states = await self.get_encoded_states(contract_hashes, block_no)
+        # variables stored per key are returned as their meta
+        return {
+            contract_hash: {k: deserialize(bytes.fromhex(v)) if type(v) is str else v for k, v in encoded_state.items()}
+            for contract_hash, (encoded_state, _, _) in encoded_states.items()
+        }
 
     async def get_contracts_source(self, contracts_hashes: list):
         async with self.database.pool.acquire() as connection:
             rows = await connection.fetch('SELECT contract_hash, source_code FROM dvm WHERE contract_hash = ANY($1)', contracts_hashes)
         return {row['contract_hash']: row['source_code'] for row in rows}
 
-    async def update_contract_states(self, contract_states: dict, block_no: int):
+    def encode_variable(self, contract: Contract, key: str, block_no: int, storage_rows: list):
+        value = contract._variables[key]
+        if type(value) is StorageMap:
+            return value.persist(block_no, storage_rows)
+        if STORAGE_MODE == 'keyed' and type(value) is dict:
+            return StorageMap.convert(contract._contract_hash, key, value, block_no, storage_rows)
+        return serialize(value).hex()
+
+    def encode_contract_states(self, contracts: Dict[str, Contract], block_no: int):
+        creation_rows = []
+        rows = []
+        storage_rows = []
+        for contract_hash, contract in contracts.items():
+            created = contract._creation is not None
+            if not created and not contract._dirty:
+                continue
+            keys = contract._variables if created else contract._dirty
+            encoded = {k: self.encode_variable(contract, k, block_no, storage_rows) for k in keys}
+            if created:
+                encoded_state = diff = encoded
+                creation_rows.append((contract_hash, *contract._creation, block_no))
+                contract._creation = None
+            else:
+                encoded_state = contract._encoded_state | encoded
+                diff = {k: v for k, v in encoded.items() if contract._encoded_state.get(k) != v}
+            contract._dirty.clear()
+            if not created and not diff:
+                continue
+            if created or contract._state_diffs >= STATE_CHECKPOINT_INTERVAL:
+                rows.append((contract_hash, json.dumps(encoded_state), block_no, True))
+                contract._state_diffs = 0
+            else:
+                rows.append((contract_hash, json.dumps(diff), block_no, False))
+                contract._state_diffs += 1
+            contract._encoded_state, contract._state_block = encoded_state, block_no
+        return creation_rows, rows, storage_rows
+
+    async def commit_block(self, block_no: int, contracts: Dict[str, Contract], transactions: list, events: list, blocks: list):
+        """Writes the created contracts, states, transactions and events of a block in a single database transaction.
+
+        blocks are the (block_no, block_hash) of the blocks executed since the last commit, the block itself included.
+        """
+        creation_rows, state_rows, storage_rows = self.encode_contract_states(contracts, block_no)
+        tables = (
+            ('dvm', ('contract_hash', 'creation_transaction', 'source_code', 'block_no'), creation_rows),
+            ('dvm_state', ('contract_hash', 'state', 'block_no', 'checkpoint'), state_rows),
+            ('dvm_storage', ('contract_hash', 'var', 'key', 'block_no', 'position', 'value'), storage_rows),
+            ('dvm_transactions', ('contract_hash', 'tx_hash', 'output_index', 'payload', 'block_no'), [(*transaction, block_no) for transaction in transactions]),
+            ('dvm_events', ('tx_hash', 'output_index', 'contract_hash', 'name', 'args'), events),
+            ('dvm_blocks', ('block_no', 'block_hash'), blocks),
+        )
+        # contracts changed in the block point to it, and to it as checkpoint when one has been written.
+        # the others already have a pointer, since contracts are created with a checkpoint
+        checkpoints = {row[0] for row in state_rows if row[3]}
+        changed = {row[0] for row in state_rows} | {row[0] for row in storage_rows}
         async with self.database.pool.acquire() as connection:
-            await connection.executemany(
-                'INSERT INTO dvm_state(contract_hash, state, block_no) VALUES($1, $2, $3)',
-                [(contract_hash, state, block_no) for contract_hash, state in contract_states.items()],
-            )
+            async with connection.transaction():
+                for table, columns, records in tables:
+                    if records:
+                        await connection.copy_records_to_table(table, records=records, columns=columns)
+                if checkpoints:
+                    await connection.executemany(
+                        'INSERT INTO dvm_latest_state(contract_hash, block_no, checkpoint_block_no) VALUES($1, $2, $2) '
+                        'ON CONFLICT (contract_hash) DO UPDATE SET block_no = EXCLUDED.block_no, checkpoint_block_no = EXCLUDED.checkpoint_block_no',
+                        [(contract_hash, block_no) for contract_hash in checkpoints]
+                    )
+                if changed - checkpoints:
+                    await connection.executemany(
+                        'UPDATE dvm_latest_state SET block_no = $2 WHERE contract_hash = $1',
+                        [(contract_hash, block_no) for contract_hash in changed - checkpoints]
+                    )
 
-    async def add_transactions(self, rows: list):
+    async def rollback(self, block_no: int):
+        """Deletes what has been written for the blocks after the last one up to block_no that is still in the chain.
+
+        Returns the number of the first block to execute again and the hash of the block before it.
+        """
         async with self.database.pool.acquire() as connection:
-            await connection.executemany(
-                'INSERT INTO dvm_transactions(contract_hash, tx_hash, output_index, payload) VALUES($1, $2, $3, $4)',
-                rows
+            # blocks are chained, so every block before the last one with the same hash is the same too
+            fork_point = await connection.fetchrow(
+                'SELECT d.block_no, d.block_hash FROM dvm_blocks d JOIN blocks b ON b.id = d.block_no AND b.hash = d.block_hash '
+                'WHERE d.block_no <= $1 ORDER BY d.block_no DESC LIMIT 1',
+                block_no
             )
-    
-    async def add_events(self, rows: list):
+            if fork_point is None:
+                fork_point = (await connection.fetchval('SELECT MIN(block_no) FROM dvm_blocks') or 1) - 1, None
+            fork_block_no = fork_point[0] + 1
+            async with connection.transaction():
+                await connection.execute(
+                    'DELETE FROM dvm_events e USING dvm_transactions t '
+                    'WHERE e.tx_hash = t.tx_hash AND e.output_index = t.output_index AND t.block_no >= $1',
+                    fork_block_no
+                )
+                await connection.execute('DELETE FROM dvm_transactions WHERE block_no >= $1', fork_block_no)
+                # contracts created after the fork are deleted with every row referencing them
+                await connection.execute('DELETE FROM dvm WHERE block_no >= $1', fork_block_no)
+                await connection.execute('DELETE FROM dvm_state WHERE block_no >= $1', fork_block_no)
+                await connection.execute('DELETE FROM dvm_storage WHERE block_no >= $1', fork_block_no)
+                # the other contracts changed after the fork point to their remaining latest state
+                await connection.execute(
+                    'UPDATE dvm_latest_state l SET block_no = s.block_no, checkpoint_block_no = s.checkpoint_block_no FROM ('
+                    'SELECT contract_hash, MAX(block_no) AS block_no, MAX(block_no) FILTER (WHERE checkpoint) AS checkpoint_block_no '
+                    'FROM dvm_state WHERE contract_hash IN (SELECT contract_hash FROM dvm_latest_state WHERE block_no >= $1) '
+                    'GROUP BY contract_hash) s WHERE l.contract_hash = s.contract_hash',
+                    fork_block_no
+                )
+                await connection.execute('DELETE FROM dvm_blocks WHERE block_no >= $1', fork_block_no)
+        # states cached as final may have been rolled back
+        self.historical_states.clear()
+        return fork_block_no, fork_point[1]
+
+    async def load_storage(self, storage_map: StorageMap, keys: list = None):
+        query = 'SELECT DISTINCT ON (key) key, position, value FROM dvm_storage WHERE contract_hash = $1 AND var = $2 AND block_no >= $3'
+        args = [storage_map._contract_hash, storage_map._var, storage_map._since]
+        if storage_map._until is not None:
+            args.append(storage_map._until)
+            query += f' AND block_no <= ${len(args)}'
+        if keys is not None:
+            encoded_keys = []
+            for key in keys:
+                try:
+                    encoded_keys.append(StorageMap.encode_key(key))
+                except (TypeError, ValueError, OverflowError):
+                    # keys that cannot be encoded cannot be stored either
+                    pass
+            keys = encoded_keys
+            args.append([key.hex() for key in keys])
+            query += f' AND key = ANY(${len(args)})'
         async with self.database.pool.acquire() as connection:
-            await connection.executemany(
-                'INSERT INTO dvm_events(tx_hash, output_index, contract_hash, name, args) VALUES($1, $2, $3, $4, $5)',
-                rows
-            )
+            rows = await connection.fetch(query + ' ORDER BY key, block_no DESC', *args)
+        storage_map.load(rows, keys)
+
+    async def prefetch_storage(self, contract_keys: Dict[str, set]):
+        """Loads in bulk the entries of the storage maps of the contracts that are likely to be accessed, e.g. call arguments."""
+        context = ExecutionContext.current()
+        for contract_hash, keys in contract_keys.items():
+            contract = context.contracts.get(contract_hash)
+            if contract is None or type(contract._variables) is not LazyState:
+                continue
+            for storage_map in contract._variables.storage_maps.values():
+                if storage_map._complete:
+                    continue
+                missing = []
+                for key in keys:
+                    try:
+                        if StorageMap.encode_key(key) not in storage_map._sizes:
+                            missing.append(key)
+                    except (TypeError, ValueError, OverflowError):
+                        pass
+                if missing:
+                    await self.load_storage(storage_map, missing)
+
+    async def run_method(self, seconds: float | None, func, *args, **kwargs):
+        """Runs a contract method, loading the storage entries it misses and running it again from the same state."""
+        context = ExecutionContext.current()
+        instances, contract_hash = list(context.contract_instances), context.current_contract_hash
+        additional_gas, emitted_events = context.additional_gas, list(context.emitted_events)
+        misses = 0
+        while True:
+            context.storage_misses = []
+            try:
+                if seconds is not None:
+                    result = await timeout(seconds, func, *args, **kwargs)
+                else:
+                    result = func(*args, **kwargs)
+                    if inspect.isawaitable(result):
+                        result = await result
+            except (Exception, KeyboardInterrupt):
+                if not context.storage_misses:
+                    raise
+            else:
+                if not context.storage_misses:
+                    return result
+            # contract code may catch the miss, so the recorded ones are used instead
+            if context.journal is not None:
+                context.journal.revert(context.contracts)
+            context.contract_instances, context.current_contract_hash = list(instances), contract_hash
+            context.additional_gas, context.emitted_events = additional_gas, list(emitted_events)
+            misses += len(context.storage_misses)
+            for storage_map, key in context.storage_misses:
+                if not storage_map._complete:
+                    await self.load_storage(storage_map, None if key is None or misses > MAX_STORAGE_MISSES else [key])
 
-    async def read_contract(self, contract_hash: str, method: str, args: tuple):
-        contracts = await self.get_contracts([contract_hash])
+    async def read_variable(self, contract: Contract, name: str):
+        value = contract._variables[name]
+        if type(value) is StorageMap:
+            if not value._complete:
+                await self.load_storage(value)
+            return value.copy()
+        return value
+
+    async def read_contract(self, contract_hash: str, method: str, args: tuple, at_block: int = None):
+        contracts = await self.get_contracts([contract_hash], at_block)
         contract = contracts[contract_hash]
+        ExecutionContext.current().block_no = at_block
         if method in contract._variables:
-            return contract._variables[method]
-        return contract._methods[method](*args)
+            return await self.read_variable(contract, method)
+        return await self.run_method(None, contract._methods[method], *args)
+
+    async def execute_call(self, call: dict, block_no: int):
+        """Executes a call of a block, returns its dvm_transactions row and its dvm_events rows, or None if it has been reverted."""
+        context = ExecutionContext.current()
+        contract_call, tx_hash, output_index, sender = call['contract_call'], call['tx_hash'], call['output_index'], call['sender']
+
+        journal = context.journal = Journal()
+        context.current_transaction = call['dvm_tx']
+        context.additional_gas = 0
+        context.gas_limit = call['fees'] / call['fee_rate']
+        context.metered = GAS_METERING_BLOCK is not None and block_no >= GAS_METERING_BLOCK
+        context.emitted_events = []
+        context.created_contracts = []
+
+        if isinstance(contract_call, ContractCreation):
+            if contract := await self.create_contract(contract_call, call['contract_creation_hash'], tx_hash, block_no, sender, contract_call.args):
+                if context.metered:
+                    # added to the gas metered while running the constructor
+                    context.additional_gas += len(contract_call.source_code)
+                else:
+                    # the gas of the constructor, such as the one of get_block, is not charged
+                    context.additional_gas = len(contract_call.source_code)
+            else:
+                journal.revert(context.contracts)
+                return None
+        else:
+            contract = context.contracts[contract_call.contract_hash]
+            context.current_contract_hash = contract_call.contract_hash
+            context.contract_instances = [contract_call.contract_hash]
+            if contract_call.contract_hash not in context.contracts:
+                print(f'Skipping call because contract {contract_call.contract_hash} does not exist')
+                return None
+            if contract_call.method == 'constructor':  # fixme
+                print('Cannot call constructor')
+                return None
+            if contract_call.method not in contract._methods:
+                print(f'Skipping call because contract {contract_call.contract_hash} does not have {contract_call.method} method')
+                return None
+            try:
+                await self.run_method(CONTRACT_METHOD_TIMEOUT, contract._methods[contract_call.method], Address(sender), *contract_call.args)
+            except (Exception, KeyboardInterrupt) as e:
+                journal.revert(context.contracts)
+                print(f'Transaction in contract {contract_call.contract_hash} reverted because of {e.__class__.__name__}: {str(e)}')
+                raise
+                return None
+
+        # todo fix implementation
+        """if context.created_contracts:
+            for i, (creator_contract_hash, class_name, specifier, args, kwargs) in enumerate(context.created_contracts):
+                source_code = (await self.get_contracts_source(creator_contract_hash))[creator_contract_hash]
+                source_code += f'Contract.deploy({class_name})'
+                contract_creation = ContractCreation(specifier, source_code, ())
+                contract_creation_hash = sha256(bytes.fromhex(call['contract_creation_hash']) + bytes([i]))
+                if contract := await self.create_contract(contract_creation, contract_creation_hash, tx_hash, block_no, creator_contract_hash, args, kwargs):
+                    context.contracts[contract_creation_hash] = contract"""
+
+        state_size_delta = journal.state_size_delta(context.contracts)
+
+        print(state_size_delta, 'bytes for state change')
+
+        if context.emitted_events:
+            events_size = serialized_size([event.to_dict() for _, event in context.emitted_events])
+            state_size_delta += events_size
+            print(events_size, 'bytes for events')
+
+        print(context.additional_gas, 'additional_gas')
+        total_gas = state_size_delta + len(context.contract_instances) * 1024 + context.additional_gas
+        print(total_gas, 'total gas')
+        fees_required = total_gas * call['fee_rate']
+
+        if call['fees'] < fees_required:
+            journal.revert(context.contracts)
+            print(total_gas, call['fee_rate'])
+            print(f'Transaction in contract {contract_call.contract_hash} reverted because of not enough gas: sent {call["fees"]} while required {fees_required}')
+            return None
+
+        emitted_events = [(tx_hash, output_index, contract_hash, *event.to_tuple()) for contract_hash, event in context.emitted_events]
+
+        print(fees_required, contract._variables)
+
+        journal.commit()
+        return (contract._contract_hash, tx_hash, output_index, contract_call.get_payload().hex()), emitted_events
 
     # contract VM methods
 
     async def get_block(self, block_no_or_block_hash: str | int):
-        ContractsCache.additional_gas += 512
+        context = ExecutionContext.current()
+        context.additional_gas += 512
         block = await (self.database.get_block(block_no_or_block_hash) if isinstance(block_no_or_block_hash, str) else self.database.get_block_by_id(block_no_or_block_hash))
         if not block:
             raise Exception(f'Block {block_no_or_block_hash} not found')